@@ -0,0 +1,19 @@
+import os
+
+# the bot under test needs these for its webhook, and the load generator sends
+# the token, benchmarks never talk to the real services
+for name in ("WEB_TELEGRAM_TOKEN", "WEB_SECRET_PING", "WEB_SECRET_PASSWORD"):
+    os.environ.setdefault(name, "benchmark")
+
+
+def report(title: str, rows: list[tuple[str, dict[str, float | int | str]]]) -> None:
+    print(f"\n== {title}")
+
+    for label, values in rows:
+        print(
+            f"{label:<32}",
+            "  ".join(
+                f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                for key, value in values.items()
+            ),
+        )
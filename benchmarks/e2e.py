@@ -0,0 +1,340 @@
+"""Throughput, per-command latency and memory of the whole bot, as
+bigmeow.main runs it
+
+Every upstream, the Telegram Bot API and the Discord REST API and gateway
+are served by local stand-ins, bigmeow.main runs in a subprocess against
+them, and each command is sent through the Telegram webhook and the Discord
+gateway and timed until its reply arrives. No network access is needed.
+
+    $ python -m benchmarks.e2e [--rounds 100] [--concurrency 8] [--workers 2]
+        [--ingest webhook|polling] [--shards 1] [--shard-processes 0]
+        [--runtime threads|loop] [--event-loop asyncio|uvloop]
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+import benchmarks
+from benchmarks import messenger, upstream
+from bigmeow.loadgen import Telegram_API, percentile, update_create
+
+COMMANDS = {
+    "meow": "meow",
+    "meowfact": "!meowfact",
+    "meowisblocked": "!meowisblocked example.com",
+    "meowpetrol": "!meowpetrol",
+    "meowsay": "!meowsay hello",
+    "meowthink": "!meowthink hello",
+}
+TIMEOUT = 30
+
+# every request comes from a chat of its own, so the per-chat send limits
+# never get in the way, and update ids never repeat
+id_count = itertools.count(10_000)
+
+
+class Bot_Process:
+    def __init__(self, environ: dict[str, str]) -> None:
+        self.log = tempfile.NamedTemporaryFile(
+            "w+", prefix="bigmeow-e2e-", suffix=".log", delete=False
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "bigmeow.main"],
+            env=environ,
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+    def memory_peak(self) -> dict[str, float]:
+        # VmHWM is the peak resident set of each process, in kB
+        result = {}
+
+        for pid in process_tree(self.process.pid):
+            try:
+                status = Path(f"/proc/{pid}/status").read_text()
+            except OSError:
+                continue
+
+            for line in status.splitlines():
+                if line.startswith("VmHWM:"):
+                    result[str(pid)] = int(line.split()[1]) / 1024
+
+        return result
+
+    def stop(self) -> int:
+        self.process.send_signal(signal.SIGINT)
+
+        try:
+            return self.process.wait(timeout=TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+
+            return self.process.wait()
+
+
+def environ_create(
+    ports: dict[str, int],
+    workers: int,
+    ingest: str = "webhook",
+    shards: int = 1,
+    shard_processes: int = 0,
+    runtime: str = "threads",
+    event_loop: str = "asyncio",
+) -> dict[str, str]:
+    upstream.environ_setup(f"http://127.0.0.1:{ports['upstream']}")
+
+    return os.environ | {
+        "BOT_RUNTIME": runtime,
+        "DEBUG": "True",
+        "DISCORD_GLOBAL_RATE": "100000",
+        "DISCORD_IDENTIFY_INTERVAL": "0",
+        "DISCORD_PROCESSES": str(shard_processes),
+        "DISCORD_SHARD_COUNT": str(shards),
+        "DISCORD_TOKEN": "benchmark",
+        "EVENT_LOOP": event_loop,
+        "IFTTT_KEY": "benchmark",
+        "TELEGRAM_GLOBAL_RATE": "100000",
+        "TELEGRAM_INGEST": ingest,
+        "TELEGRAM_POLL_TIMEOUT": "1",
+        "TELEGRAM_TOKEN": "4242:benchmark",
+        "URL_DISCORD_API": f"http://127.0.0.1:{ports['discord']}/api/v10",
+        "URL_DISCORD_GATEWAY": f"ws://127.0.0.1:{ports['discord']}/gateway/",
+        "URL_TELEGRAM": f"http://127.0.0.1:{ports['telegram']}/bot",
+        "WEBHOOK_PORT": str(ports["web"]),
+        "WEBHOOK_URL": f"http://127.0.0.1:{ports['web']}",
+        "WEB_WORKERS": str(workers),
+    }
+
+
+def process_tree(root: int) -> list[int]:
+    parent_dict: dict[int, int] = {}
+
+    for stat in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # the command name may contain spaces, the fields after it do not
+            fields = stat.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+
+        parent_dict[int(stat.parent.name)] = int(fields[1])
+
+    result, pending = [], [root]
+    while pending:
+        result.append(pid := pending.pop())
+        pending.extend(child for child, parent in parent_dict.items() if parent == pid)
+
+    return result
+
+
+async def command_measure(send, rounds: int, concurrency: int) -> dict:
+    latencies, errors, semaphore = [], 0, asyncio.Semaphore(concurrency)
+
+    async def once() -> None:
+        nonlocal errors
+
+        async with semaphore:
+            started = time.perf_counter()
+
+            try:
+                replied = await asyncio.wait_for(await send(), timeout=TIMEOUT)
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                errors += 1
+            else:
+                latencies.append((replied - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(once() for _ in range(rounds)))
+
+    return {
+        "rps": len(latencies) / (time.perf_counter() - started),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "errors": errors,
+    }
+
+
+async def ready_wait(
+    bot: Bot_Process,
+    telegram: Telegram_API,
+    discord: messenger.Discord_API,
+    web_url: str,
+) -> None:
+    async with aiohttp.ClientSession() as session:
+        for _ in range(TIMEOUT * 10):
+            if bot.process.poll() is not None:
+                raise RuntimeError(f"bigmeow.main exited, see {bot.log.name}")
+
+            try:
+                async with session.get(f"{web_url}/readyz") as response:
+                    if (
+                        response.status == 200
+                        and telegram.ready.is_set()
+                        and discord.ready.is_set()
+                    ):
+                        return
+            except aiohttp.ClientError:
+                pass
+
+            await asyncio.sleep(0.1)
+
+    raise RuntimeError(f"bigmeow.main is not ready, see {bot.log.name}")
+
+
+async def run(
+    rounds: int,
+    concurrency: int,
+    workers: int,
+    ingest: str,
+    shards: int,
+    shard_processes: int,
+    runtime: str,
+    event_loop: str,
+) -> None:
+    ports = {
+        name: upstream.port_reserve()
+        for name in ("upstream", "telegram", "discord", "web")
+    }
+    telegram, discord = Telegram_API(), messenger.Discord_API(shards)
+    runner_list = [
+        await upstream.serve(ports["upstream"]),
+        await messenger.serve(telegram.app_create(), ports["telegram"]),
+        await messenger.serve(discord.app_create(), ports["discord"]),
+    ]
+
+    web_url = f"http://127.0.0.1:{ports['web']}"
+    bot = Bot_Process(
+        environ_create(
+            ports, workers, ingest, shards, shard_processes, runtime, event_loop
+        )
+    )
+
+    async with aiohttp.ClientSession() as session:
+
+        def telegram_send(text: str):
+            async def send() -> asyncio.Future:
+                chat_id, message_id = next(id_count), next(id_count)
+                reply = telegram.expect(chat_id, message_id)
+                update = update_create(message_id, chat_id, message_id, text)
+
+                if ingest == "polling":
+                    telegram.update_queue.put_nowait(update)
+
+                    return reply
+
+                async with session.post(
+                    f"{web_url}/telegram",
+                    json=update,
+                    headers={
+                        "X-Telegram-Bot-Api-Secret-Token": os.environ[
+                            "WEB_TELEGRAM_TOKEN"
+                        ]
+                    },
+                ) as response:
+                    response.raise_for_status()
+
+                return reply
+
+            return send
+
+        def discord_send(text: str):
+            async def send() -> asyncio.Future:
+                channel_id, message_id = next(id_count), next(id_count)
+                reply = discord.expect(channel_id, message_id)
+
+                await discord.dispatch(channel_id, message_id, text)
+
+                return reply
+
+            return send
+
+        try:
+            await ready_wait(bot, telegram, discord, web_url)
+
+            # one of everything first, so caches and connections are warm
+            for text in COMMANDS.values():
+                await command_measure(telegram_send(text), 1, 1)
+                await command_measure(discord_send(text), 1, 1)
+
+            result = []
+            for platform, send in (
+                ("telegram", telegram_send),
+                ("discord", discord_send),
+            ):
+                for name, text in COMMANDS.items():
+                    result.append(
+                        (
+                            f"{platform} {name}",
+                            await command_measure(send(text), rounds, concurrency),
+                        )
+                    )
+
+            memory = bot.memory_peak()
+        finally:
+            bot.stop()
+
+            for runner in runner_list:
+                await runner.cleanup()
+
+    benchmarks.report(
+        f"bigmeow.main with {workers} web workers, {rounds} rounds per command, "
+        f"{concurrency} in flight, telegram through {ingest}, "
+        f"{shards} discord shards in {shard_processes or 'the bot'} processes, "
+        f"{runtime} runtime on {event_loop}",
+        result,
+    )
+    benchmarks.report(
+        "Photo bytes uploaded, photos already uploaded are sent by reference",
+        [
+            ("telegram", {"mb": telegram.upload_bytes / 1024 / 1024}),
+            ("discord", {"mb": discord.upload_bytes / 1024 / 1024}),
+        ],
+    )
+    benchmarks.report(
+        "Peak resident memory (VmHWM) per process",
+        [(f"pid {pid}", {"mb": mb}) for pid, mb in memory.items()]
+        + [("total", {"mb": sum(memory.values())})],
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--ingest", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--shard-processes", type=int, default=0)
+    parser.add_argument("--runtime", choices=("threads", "loop"), default="threads")
+    parser.add_argument(
+        "--event-loop", choices=("asyncio", "uvloop"), default="asyncio"
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        run(
+            args.rounds,
+            args.concurrency,
+            args.workers,
+            args.ingest,
+            args.shards,
+            args.shard_processes,
+            args.runtime,
+            args.event_loop,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Wakeup latency and parked threads for settings.Event and settings.PEvent
+
+Compares the pipe-backed primitives against the previous executor polling
+implementation, kept here as Polling_Event/Polling_PEvent.
+
+    $ python -m benchmarks.event [--waiters 8] [--rounds 50]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import threading
+import time
+from functools import partial
+
+import benchmarks
+from bigmeow import settings
+from bigmeow.loadgen import percentile
+
+
+class Polling_Event(threading.Event):
+    async def wait(self, timeout: int | None = 5) -> bool:
+        while True:
+            task = asyncio.get_event_loop().run_in_executor(
+                None, partial(super().wait, timeout)
+            )
+            await task
+
+            if result := task.result():
+                return result
+
+
+class Polling_PEvent:
+    def __init__(self, event) -> None:
+        self.event = event
+
+    def set(self):
+        self.event.set()
+
+    async def wait(self, timeout: int | None = 5) -> bool:
+        while True:
+            task = asyncio.get_event_loop().run_in_executor(
+                None, partial(self.event.wait, timeout)
+            )
+            await task
+
+            if result := task.result():
+                return result
+
+
+async def thread_waiters(event_factory, waiters: int, rounds: int) -> dict:
+    latencies, threads = [], 0
+
+    for _ in range(rounds):
+        event, woken = event_factory(), []
+
+        async def waiter() -> None:
+            await event.wait()
+            woken.append(time.perf_counter())
+
+        tasks = [asyncio.create_task(waiter()) for _ in range(waiters)]
+        await asyncio.sleep(0.01)
+
+        threads = max(threads, threading.active_count())
+        started = time.perf_counter()
+        threading.Thread(target=event.set).start()
+
+        await asyncio.gather(*tasks)
+        latencies.extend((stamp - started) * 1000 for stamp in woken)
+
+    return {
+        "threads": threads,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def process_waiter(event, ready, result) -> None:
+    async def waiter() -> None:
+        ready.set()
+        await event.wait()
+        result.put(time.perf_counter())
+
+    asyncio.run(waiter())
+
+
+def process_waiters(event_factory, rounds: int) -> dict:
+    latencies = []
+    ready, result = multiprocessing.Event(), multiprocessing.Queue()
+
+    for _ in range(rounds):
+        event = event_factory()
+        ready.clear()
+
+        process = multiprocessing.Process(
+            target=process_waiter, args=(event, ready, result)
+        )
+        process.start()
+        ready.wait()
+        time.sleep(0.01)
+
+        started = time.perf_counter()
+        event.set()
+        latencies.append((result.get() - started) * 1000)
+        process.join()
+
+    return {
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--waiters", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    benchmarks.report(
+        f"Event, {args.waiters} waiters on one loop, woken from another thread",
+        [
+            (
+                "before (executor polling)",
+                asyncio.run(thread_waiters(Polling_Event, args.waiters, args.rounds)),
+            ),
+            (
+                "after (pipe wakeup)",
+                asyncio.run(thread_waiters(settings.Event, args.waiters, args.rounds)),
+            ),
+        ],
+    )
+
+    manager = multiprocessing.Manager()
+    benchmarks.report(
+        "PEvent, waiter in a child process",
+        [
+            (
+                "before (manager event polling)",
+                process_waiters(
+                    lambda: Polling_PEvent(manager.Event()), args.rounds // 5 or 1
+                ),
+            ),
+            (
+                "after (pipe wakeup)",
+                process_waiters(settings.PEvent, args.rounds // 5 or 1),
+            ),
+        ],
+    )
+    manager.shutdown()
+
+
+if __name__ == "__main__":
+    main()
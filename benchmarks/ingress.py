@@ -0,0 +1,99 @@
+"""Saturation point of the webhook ingress, from /telegram and /chat to the
+reply reaching the Bot API sink
+
+Runs bigmeow.main against local stand-ins like benchmarks.e2e, then steps
+bigmeow.loadgen through increasing request rates. Once the reply rate stops
+following the request rate, or acknowledgements start being rejected, the
+web to bot queue hop is saturated.
+
+    $ python -m benchmarks.ingress [--rate 50,100,200,400] [--duration 5]
+        [--event-loop asyncio|uvloop]
+"""
+
+import argparse
+import asyncio
+import os
+
+import benchmarks
+from benchmarks import e2e, messenger, upstream
+from bigmeow.loadgen import Load_Generator, Telegram_API
+
+
+async def run(
+    rate_list: list[float],
+    duration: float,
+    concurrency: int,
+    chat_ratio: float,
+    workers: int,
+    event_loop: str,
+) -> None:
+    ports = {
+        name: upstream.port_reserve()
+        for name in ("upstream", "telegram", "discord", "web")
+    }
+    telegram, discord = Telegram_API(), messenger.Discord_API()
+    runner_list = [
+        await upstream.serve(ports["upstream"]),
+        await messenger.serve(telegram.app_create(), ports["telegram"]),
+        await messenger.serve(discord.app_create(), ports["discord"]),
+    ]
+
+    web_url = f"http://127.0.0.1:{ports['web']}"
+    bot = e2e.Bot_Process(e2e.environ_create(ports, workers, event_loop=event_loop))
+    generator = Load_Generator(
+        web_url, telegram, os.environ["WEB_TELEGRAM_TOKEN"], chat_ratio=chat_ratio
+    )
+
+    try:
+        await e2e.ready_wait(bot, telegram, discord, web_url)
+
+        result = [
+            (
+                f"{rate:g} requests per second",
+                await generator.run(rate, duration, concurrency),
+            )
+            for rate in rate_list
+        ]
+    finally:
+        bot.stop()
+
+        for runner in runner_list:
+            await runner.cleanup()
+
+    benchmarks.report(
+        f"bigmeow.main with {workers} web workers on {event_loop}, "
+        f"{chat_ratio:.0%} through /chat",
+        result,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rate",
+        type=lambda value: [float(rate) for rate in value.split(",")],
+        default=[50.0, 100.0, 200.0, 400.0],
+    )
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--chat-ratio", type=float, default=0.2)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument(
+        "--event-loop", choices=("asyncio", "uvloop"), default="asyncio"
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        run(
+            args.rate,
+            args.duration,
+            args.concurrency,
+            args.chat_ratio,
+            args.workers,
+            args.event_loop,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""Local stand-ins for the Discord REST API and gateway
+
+The Telegram Bot API stand-in is the sink in bigmeow.loadgen. Like that
+one, this keeps a future per outgoing message, keyed by the channel and the
+message being replied to, so a benchmark can time a command from the moment
+it is sent until its reply arrives.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import WSMsgType, web
+
+from bigmeow.loadgen import BOT_ID
+
+
+class Discord_API:
+    def __init__(self, shards: int = 1) -> None:
+        # ready once every shard has identified, events are spread across them
+        self.shards = shards
+        self.reply_dict: dict[tuple[int, int], asyncio.Future] = {}
+        self.ready = asyncio.Event()
+        self.socket_list: list[web.WebSocketResponse] = []
+        self.message_id, self.sequence = itertools.count(1), itertools.count(1)
+
+        # bytes of every file the bot uploaded, rather than linked to
+        self.upload_bytes = 0
+
+    def app_create(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_get("/api/v10/users/@me", self.user_get)
+        app.router.add_get("/api/v10/oauth2/applications/@me", self.application_get)
+        app.router.add_get("/api/v10/gateway/bot", self.gateway_bot_get)
+        app.router.add_get("/api/v10/gateway", self.gateway_bot_get)
+        app.router.add_post(
+            "/api/v10/channels/{channel_id}/messages", self.message_post
+        )
+        app.router.add_get("/gateway/", self.gateway_get)
+
+        return app
+
+    async def application_get(self, _request: web.Request) -> web.Response:
+        return json_response(
+            {
+                "id": str(BOT_ID),
+                "name": "BigMeow",
+                "description": "",
+                "icon": None,
+                "bot_public": False,
+                "bot_require_code_grant": False,
+                "owner": discord_user(1, False),
+                "verify_key": "",
+                "flags": 0,
+            }
+        )
+
+    async def dispatch(self, channel_id: int, message_id: int, content: str) -> None:
+        event = {
+            "op": 0,
+            "t": "MESSAGE_CREATE",
+            "s": next(self.sequence),
+            "d": {
+                **discord_message(message_id, channel_id, content),
+                "author": discord_user(channel_id, False),
+            },
+        }
+
+        await self.socket_list[message_id % len(self.socket_list)].send_json(event)
+
+    def expect(self, channel_id: int, message_id: int) -> asyncio.Future:
+        future = self.reply_dict[(channel_id, message_id)] = (
+            asyncio.get_running_loop().create_future()
+        )
+
+        return future
+
+    async def gateway_bot_get(self, request: web.Request) -> web.Response:
+        return json_response(
+            {
+                "url": f"ws://{request.host}/gateway/",
+                "shards": self.shards,
+                "session_start_limit": {
+                    "total": 1000,
+                    "remaining": 1000,
+                    "reset_after": 0,
+                    "max_concurrency": 1,
+                },
+            }
+        )
+
+    async def gateway_get(self, request: web.Request) -> web.WebSocketResponse:
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        await socket.send_json({"op": 10, "d": {"heartbeat_interval": 45000}})
+
+        async for message in socket:
+            if message.type != WSMsgType.TEXT:
+                continue
+
+            payload = message.json()
+
+            if payload["op"] == 1:
+                await socket.send_json({"op": 11})
+
+            elif payload["op"] == 2:
+                shard = payload["d"].get("shard", [0, 1])
+                await socket.send_json(
+                    {
+                        "op": 0,
+                        "t": "READY",
+                        "s": next(self.sequence),
+                        "d": {
+                            "v": 10,
+                            "user": discord_user(BOT_ID, True),
+                            "guilds": [],
+                            "session_id": f"benchmark-{shard[0]}",
+                            "resume_gateway_url": f"ws://{request.host}/gateway/",
+                            "shard": shard,
+                            "application": {"id": BOT_ID, "flags": 0},
+                        },
+                    }
+                )
+
+                self.socket_list.append(socket)
+
+                if len(self.socket_list) >= self.shards:
+                    self.ready.set()
+
+        if socket in self.socket_list:
+            self.socket_list.remove(socket)
+
+        return socket
+
+    async def message_post(self, request: web.Request) -> web.Response:
+        channel_id = int(request.match_info["channel_id"])
+
+        attachment_list = []
+
+        if request.content_type == "multipart/form-data":
+            form = await request.post()
+            payload = json.loads(form["payload_json"])
+
+            for value in form.values():
+                if isinstance(value, web.FileField):
+                    size = len(value.file.read())
+                    self.upload_bytes += size
+                    attachment_list.append(
+                        discord_attachment(next(self.message_id), value.filename, size)
+                    )
+        else:
+            payload = await request.json()
+
+        reply_to = int((payload.get("message_reference") or {}).get("message_id", 0))
+
+        if future := self.reply_dict.pop((channel_id, reply_to), None):
+            future.done() or future.set_result(time.perf_counter())
+
+        return json_response(
+            {
+                **discord_message(
+                    next(self.message_id), channel_id, payload.get("content") or ""
+                ),
+                "author": discord_user(BOT_ID, True),
+                "attachments": attachment_list,
+            }
+        )
+
+    async def user_get(self, _request: web.Request) -> web.Response:
+        return json_response(discord_user(BOT_ID, True))
+
+
+def discord_attachment(attachment_id: int, filename: str, size: int) -> dict:
+    url = f"https://cdn.example.com/attachments/{attachment_id}/{filename}"
+
+    return {
+        "id": str(attachment_id),
+        "filename": filename,
+        "size": size,
+        "url": url,
+        "proxy_url": url,
+    }
+
+
+def discord_message(message_id: int, channel_id: int, content: str) -> dict:
+    return {
+        "id": str(message_id),
+        "channel_id": str(channel_id),
+        "content": content,
+        "timestamp": "2024-01-01T00:00:00.000000+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+    }
+
+
+def discord_user(user_id: int, is_bot: bool) -> dict:
+    return {
+        "id": str(user_id),
+        "username": "bigmeow" if is_bot else f"user{user_id}",
+        "discriminator": "0",
+        "global_name": None,
+        "avatar": None,
+        "bot": is_bot,
+    }
+
+
+def json_response(data: dict) -> web.Response:
+    # discord.py only decodes a body labelled exactly application/json
+    return web.Response(body=json.dumps(data).encode(), content_type="application/json")
+
+
+async def serve(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    return runner
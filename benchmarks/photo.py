@@ -0,0 +1,122 @@
+"""Size savings and event loop stalls of normalizing new cat photos, inline
+on the loop versus in the photo workers through meow.meow_photo_normalize
+
+Photos are generated with Pillow, noise over gradients, so they compress
+about as badly as a real photo does. Requires Pillow.
+
+    $ python -m benchmarks.photo [--rounds 5] [--sizes 1024,2048]
+"""
+
+import argparse
+import asyncio
+import time
+from io import BytesIO
+
+import benchmarks
+from bigmeow import meow, settings
+from bigmeow.loadgen import percentile
+from bigmeow.photo import photo_normalize
+
+LAG_INTERVAL = 0.005
+
+
+def photo_create(size: int, kind: str) -> bytes:
+    from PIL import Image
+
+    image = Image.merge(
+        "RGB",
+        (
+            Image.effect_noise((size, size), 48),
+            Image.linear_gradient("L").resize((size, size)),
+            Image.radial_gradient("L").resize((size, size)),
+        ),
+    )
+
+    output = BytesIO()
+    image.save(output, kind, **({"quality": 95} if kind == "JPEG" else {}))
+
+    return output.getvalue()
+
+
+async def lag_probe(stop: asyncio.Event) -> float:
+    # the longest the loop took to wake a task sleeping for LAG_INTERVAL
+    lag = 0.0
+
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lag = max(lag, time.perf_counter() - started - LAG_INTERVAL)
+
+    return lag
+
+
+async def normalize_measure(payload: bytes, rounds: int, is_pooled: bool) -> dict:
+    stop, latencies, size = asyncio.Event(), [], len(payload)
+    probe = asyncio.create_task(lag_probe(stop))
+
+    for _ in range(rounds):
+        started = time.perf_counter()
+
+        if is_pooled:
+            size = len((await meow.meow_photo_normalize(BytesIO(payload))).getvalue())
+        else:
+            size = len(
+                photo_normalize(
+                    payload, settings.PHOTO_BUDGET, settings.PHOTO_DIMENSION
+                )
+            )
+
+        latencies.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(LAG_INTERVAL * 2)
+
+    stop.set()
+
+    return {
+        "kb": len(payload) / 1024,
+        "normalized_kb": size / 1024,
+        "p50_ms": percentile(latencies, 50),
+        "max_lag_ms": await probe * 1000,
+    }
+
+
+async def run(rounds: int, size_list: list[int]) -> None:
+    # the first photo starts the workers, which is not what is measured here
+    await meow.meow_photo_normalize(BytesIO(photo_create(size_list[0], "PNG")))
+
+    result = []
+    for size in size_list:
+        for kind in ("PNG", "JPEG"):
+            payload = photo_create(size, kind)
+
+            for is_pooled in (False, True):
+                result.append(
+                    (
+                        f"{'pool' if is_pooled else 'inline'} {size}px {kind}",
+                        await normalize_measure(payload, rounds, is_pooled),
+                    )
+                )
+
+    meow.meow_photo_close()
+
+    benchmarks.report(
+        f"Normalizing to {settings.PHOTO_BUDGET // 1024}kB, "
+        f"at most {settings.PHOTO_DIMENSION}px, {rounds} rounds",
+        result,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[1024, 2048],
+    )
+    args = parser.parse_args()
+
+    asyncio.run(run(args.rounds, args.sizes))
+
+
+if __name__ == "__main__":
+    main()
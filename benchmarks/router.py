@@ -0,0 +1,95 @@
+"""Command routing over a realistic message mix, comparing the previous
+if/elif chain of message_contains checks with common.Command_Router
+
+    $ python -m benchmarks.router [--messages 100000]
+"""
+
+import argparse
+import random
+import time
+
+import benchmarks
+from bigmeow.common import Command_Router
+from bigmeow.settings import MeowCommand
+
+CHATTER = [
+    "good morning everyone",
+    "anyone up for lunch later?",
+    "lol that is hilarious",
+    "did you see the news today",
+    "brb, need to grab coffee",
+]
+MEOWS = ["meow", "MEOW meow", "the cat went meow at 3am", "Meowwww"]
+COMMANDS = [
+    "!meowsay hello world",
+    "!meowthink what is for dinner",
+    "!meowfact",
+    "!meowpetrol",
+    "!meowisblocked example.com",
+    "!meowprompt write me a haiku about cats",
+]
+
+
+def message_contains(message: str | None, content: str, is_command=True) -> bool:
+    message = message or ""
+
+    return (message.startswith(content)) if is_command else (content in message.lower())
+
+
+def chain_route(message: str) -> tuple[str, str] | None:
+    for command in MeowCommand:
+        if message_contains(message, str(command)):
+            return command.value, message.replace(str(command), "").strip()
+
+    if message_contains(message, "meow", is_command=False):
+        return "photo", message
+
+    return None
+
+
+def message_mix(count: int) -> list[str]:
+    return random.choices(
+        CHATTER + MEOWS + COMMANDS,
+        weights=[14] * len(CHATTER) + [4] * len(MEOWS) + [2] * len(COMMANDS),
+        k=count,
+    )
+
+
+def measure(route, message_list: list[str]) -> dict:
+    started = time.perf_counter()
+
+    for message in message_list:
+        route(message)
+
+    elapsed = time.perf_counter() - started
+
+    return {
+        "ns_per_message": elapsed / len(message_list) * 1e9,
+        "messages_per_s": len(message_list) / elapsed,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100_000)
+    args = parser.parse_args()
+
+    router = Command_Router(
+        {command: command.value for command in MeowCommand}, fallback="photo"
+    )
+    message_list = message_mix(args.messages)
+
+    for message in message_list[:1000]:
+        assert chain_route(message) == router.match(message)
+
+    benchmarks.report(
+        f"Routing {args.messages} messages",
+        [
+            ("before (if/elif chain)", measure(chain_route, message_list)),
+            ("after (prefix trie)", measure(router.match, message_list)),
+        ],
+    )
+
+
+if __name__ == "__main__":
+    main()
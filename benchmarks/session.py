@@ -0,0 +1,109 @@
+"""Per-command latency with a fresh aiohttp session per call versus the
+shared, pooled session from bigmeow.common.session_get
+
+The "before" run recreates what aiohttp.request() did, a new session and
+connector for every upstream call, against the same local stand-ins.
+
+    $ python -m benchmarks.session [--rounds 200] [--concurrency 4]
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import date
+
+import aiohttp
+
+import benchmarks
+from benchmarks import upstream
+
+PORT = upstream.port_reserve()
+upstream.environ_setup(f"http://localhost:{PORT}")
+
+from bigmeow import common, meow, settings  # noqa: E402
+from bigmeow.loadgen import percentile  # noqa: E402
+
+COMMANDS = {
+    "meowfact": lambda: meow.meow_fact(),
+    "meowisblocked": lambda: meow.meowblocked_fetch("example.com"),
+    "meowpetrol": lambda: petrol_fetch(),
+    "meowprompt": lambda: meow.meow_prompt("hello", "telegram", "[1, 2]"),
+    "photo": lambda: meow.meow_download_photo(),
+}
+
+
+async def petrol_fetch() -> str:
+    # force a refresh on every call, the cache would hide the upstream fetch
+    settings.latest_cache.store(
+        settings.Latest(
+            settings.Level(date.min, 0, 0, 0), settings.Change(date.min, 0, 0, 0)
+        )
+    )
+
+    return await meow.meow_petrol()
+
+
+async def command_measure(name: str, rounds: int, concurrency: int) -> dict:
+    latencies, semaphore = [], asyncio.Semaphore(concurrency)
+
+    async def once() -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await COMMANDS[name]()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(once() for _ in range(rounds)))
+
+    return {
+        "rps": rounds / (time.perf_counter() - started),
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+async def run(is_pooled: bool, rounds: int, concurrency: int) -> list:
+    session_list = []
+
+    def oneshot_get() -> aiohttp.ClientSession:
+        session_list.append(aiohttp.ClientSession())
+
+        return session_list[-1]
+
+    meow.session_get = common.session_get if is_pooled else oneshot_get
+
+    result = [
+        (
+            f"{'after' if is_pooled else 'before'} {name}",
+            await command_measure(name, rounds, concurrency),
+        )
+        for name in COMMANDS
+    ]
+
+    for session in session_list:
+        await session.close()
+
+    await common.session_close()
+
+    return result
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    runner = await upstream.serve(PORT)
+
+    benchmarks.report(
+        f"Upstream latency, {args.rounds} calls per command, concurrency {args.concurrency}",
+        await run(False, args.rounds, args.concurrency)
+        + await run(True, args.rounds, args.concurrency),
+    )
+
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
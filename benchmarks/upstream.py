@@ -0,0 +1,123 @@
+"""Local stand-ins for every upstream service bigmeow.meow talks to
+
+environ_setup() points the URL_* settings at the stand-in, so it has to be
+called before anything under bigmeow is imported.
+"""
+
+import asyncio
+import os
+import random
+import socket
+from datetime import date, timedelta
+
+from aiohttp import web
+
+CAT_PHOTO_SIZE = 48 * 1024
+
+
+def environ_setup(base_url: str) -> None:
+    os.environ.update(
+        {
+            "URL_BLOCKEDORNOT": f"{base_url}/blockedornot/api/",
+            "URL_CATAAS": f"{base_url}/cat/says/meow?type=square",
+            "URL_FACT": f"{base_url}/fact/",
+            "URL_IFTTT": f"{base_url}/ifttt/trigger/prompt/with/key/{{key}}",
+            "URL_PETROL": f"{base_url}/commodities/fuelprice.csv",
+        }
+    )
+
+
+def port_reserve() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+
+        return sock.getsockname()[1]
+
+
+def petrol_csv(weeks: int = 52 * 7) -> str:
+    rows, started = ["series_type,date,ron95,ron97,diesel,diesel_eastmsia"], date(
+        2017, 3, 30
+    )
+
+    for week in range(weeks):
+        day = (started + timedelta(weeks=week)).isoformat()
+        rows.append(f"level,{day},2.05,{3.07 + week / 1000:.2f},2.15,2.15")
+        rows.append(f"change_weekly,{day},0.00,0.01,0.00,0.00")
+
+    return "\n".join(rows) + "\n"
+
+
+def app_create(delay: float = 0.0) -> web.Application:
+    photo, petrol = random.randbytes(CAT_PHOTO_SIZE), petrol_csv().encode()
+    etag = f'"{hash(petrol):x}"'
+
+    async def blockedornot_get(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+
+        return web.json_response(
+            {
+                "blocked": request.query.get("query", "").startswith("blocked"),
+                "different_ip": True,
+                "measurement": "",
+            }
+        )
+
+    async def cat_get(_request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+
+        return web.Response(body=photo, content_type="image/png")
+
+    async def fact_get(_request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+
+        return web.json_response(
+            {"data": [f"Cats sleep {random.randint(12, 16)} hours a day."]}
+        )
+
+    async def ifttt_post(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        await request.json()
+
+        return web.Response(text="Congratulations! You've fired the prompt event")
+
+    async def petrol_get(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+
+        if (ranges := request.http_range).start is not None and ranges.start < 0:
+            return web.Response(
+                status=206,
+                body=petrol[ranges.start :],
+                content_type="text/csv",
+                headers={
+                    "ETag": etag,
+                    "Content-Range": f"bytes {len(petrol) + ranges.start}-{len(petrol) - 1}/{len(petrol)}",
+                },
+            )
+
+        return web.Response(
+            body=petrol, content_type="text/csv", headers={"ETag": etag}
+        )
+
+    app = web.Application()
+    app.router.add_get("/blockedornot/api/", blockedornot_get)
+    app.router.add_get("/cat/says/meow", cat_get)
+    app.router.add_get("/fact/", fact_get)
+    app.router.add_post("/ifttt/trigger/prompt/with/key/{key}", ifttt_post)
+    app.router.add_get("/commodities/fuelprice.csv", petrol_get)
+
+    return app
+
+
+async def serve(port: int, delay: float = 0.0) -> web.AppRunner:
+    runner = web.AppRunner(app_create(delay), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    return runner
+
+
+if __name__ == "__main__":
+    web.run_app(app_create(), host="127.0.0.1", port=int(os.environ.get("PORT", 8081)))
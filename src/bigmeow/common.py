@@ -1,15 +1,172 @@
+import asyncio
+import socket
 from os import environ
+from time import monotonic
+from types import SimpleNamespace
+from typing import Any, Callable, Coroutine, Generic, TypeVar
+from weakref import WeakKeyDictionary
 
+import aiohttp
+import structlog
 from dotenv import load_dotenv
 
+from bigmeow import settings
+from bigmeow.metrics import metrics
+from bigmeow.settings import MeowCommand
+
 load_dotenv()
 
+logger = structlog.get_logger()
+
+T = TypeVar("T")
+
+session_dict: WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession] = (
+    WeakKeyDictionary()
+)
+
+
+class Command_Router(Generic[T]):
+    def __init__(
+        self,
+        handlers: dict[MeowCommand, T],
+        fallback: T | None = None,
+        keyword: str = "meow",
+        prefixes: str = "!",
+    ) -> None:
+        self.fallback, self.keyword, self.prefixes = fallback, keyword, prefixes
+        self.name_dict = {
+            handler: command.value for command, handler in handlers.items()
+        }
+
+        # one level per character of the command name, the handler is kept
+        # under the None key of the node that completes a name
+        self.trie: dict[str | None, Any] = {}
+
+        for command, handler in handlers.items():
+            node = self.trie
+
+            for char in command.value:
+                node = node.setdefault(char, {})
+
+            node[None] = handler
+
+    def match(self, message: str | None) -> tuple[T, str] | None:
+        message, result = message or "", None
+
+        if message[:1] and message[:1] in self.prefixes:
+            node, end = self.trie, 0
+
+            for idx, char in enumerate(message[1:], start=1):
+                if (node := node.get(char)) is None:
+                    break
+
+                if None in node:
+                    result, end = node[None], idx + 1
+
+            if result is not None:
+                # telegram addresses commands in groups as /command@bot_name
+                if message[end : end + 1] == "@":
+                    end = len(message.split(maxsplit=1)[0])
+
+                return result, message[end:].strip()
+
+        if self.fallback is not None and self.keyword in message.lower():
+            return self.fallback, message
+
+        return None
+
+    def name(self, handler: T) -> str:
+        # the fallback answers to the keyword
+        return self.name_dict.get(handler, self.keyword)
+
 
 def check_is_debug():
     return environ.get("DEBUG", "False").upper() == "TRUE"
 
 
-def message_contains(message: str | None, content: str, is_command=True) -> bool:
-    message = message or ""
+def loop_factory() -> Callable[[], asyncio.AbstractEventLoop]:
+    if settings.EVENT_LOOP == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("COMMON: uvloop is not installed, using asyncio instead")
+        else:
+            return uvloop.new_event_loop
+
+    return asyncio.new_event_loop
+
+
+def loop_run(coro: Coroutine[Any, Any, T]) -> T:
+    # asyncio.run, on the loop EVENT_LOOP asks for, every process and every
+    # bot thread starts its loop through here
+    factory = loop_factory()
+
+    # python 3.10 has no asyncio.Runner, asyncio.run gets its loop from the
+    # policy there, which is fine as every loop in a process is the same kind
+    if not hasattr(asyncio, "Runner"):
+        if factory is not asyncio.new_event_loop:
+            policy = asyncio.DefaultEventLoopPolicy()
+            policy.new_event_loop = factory  # type: ignore
+            asyncio.set_event_loop_policy(policy)
+
+        return asyncio.run(coro)
+
+    with asyncio.Runner(loop_factory=factory) as runner:
+        return runner.run(coro)
+
+
+async def session_close() -> None:
+    if session := session_dict.pop(asyncio.get_running_loop(), None):
+        await session.close()
+
+
+def session_get() -> aiohttp.ClientSession:
+    # sessions are bound to the loop that created them, so every bot thread
+    # and process keeps its own pool of keep-alive connections
+    loop = asyncio.get_running_loop()
+
+    if (session := session_dict.get(loop)) is None or session.closed:
+        session = session_dict[loop] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings.HTTP_LIMIT,
+                limit_per_host=settings.HTTP_LIMIT_PER_HOST,
+                ttl_dns_cache=settings.HTTP_DNS_TTL,
+            ),
+            trace_configs=[session_trace()],
+        )
+
+    return session
+
+
+def session_trace() -> aiohttp.TraceConfig:
+    trace = aiohttp.TraceConfig()
+
+    async def request_start(
+        _session: aiohttp.ClientSession, context: SimpleNamespace, _params: Any
+    ) -> None:
+        context.started = monotonic()
+
+    async def request_end(
+        _session: aiohttp.ClientSession, context: SimpleNamespace, params: Any
+    ) -> None:
+        metrics.observe(
+            "bigmeow_upstream_duration_seconds",
+            monotonic() - context.started,
+            host=params.url.host or "",
+        )
+
+    trace.on_request_start.append(request_start)
+    trace.on_request_end.append(request_end)
+    trace.on_request_exception.append(request_end)
+
+    return trace
+
 
-    return (message.startswith(content)) if is_command else (content in message.lower())
+def web_workers_count() -> int:
+    # lives here so the main process can size its pool without importing the
+    # web framework, only web workers need that
+    return (
+        int(environ.get("WEB_WORKERS", "1" if check_is_debug() else "4"))
+        if hasattr(socket, "SO_REUSEPORT")
+        else 1
+    )
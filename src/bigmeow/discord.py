@@ -1,143 +1,224 @@
 import asyncio
 import json
 import os
-from io import StringIO
+from functools import partial
+from io import BytesIO, StringIO
+from time import monotonic
+from typing import Any
 
 import discord
 import structlog
+import yarl
 from dotenv import load_dotenv
 
 import bigmeow.settings as settings
-from bigmeow.common import check_is_debug, message_contains
+from bigmeow.common import Command_Router, check_is_debug, session_close
 from bigmeow.meow import (
+    PHOTO_MISSING,
     meow_blockedornot,
     meow_fact,
     meow_fetch_photo,
     meow_petrol,
+    meow_photo_digest,
     meow_prompt,
     meow_say,
 )
+from bigmeow.metrics import metrics
+from bigmeow.outbound import Lane, Send_Scheduler, Token_Bucket, retry_seconds
 from bigmeow.settings import MeowCommand
+from bigmeow.supervisor import Task_Supervisor
 
 load_dotenv()
 logger = structlog.get_logger()
 
 
-def client_init() -> discord.Client:
+def client_init(shard_ids: list[int] | None = None) -> discord.Client:
     intents = discord.Intents.default()
     intents.messages = True
     intents.message_content = True
     intents.members = True
-    return discord.Client(intents=discord.Intents(messages=True, message_content=True))
 
+    # both can point at local stand-ins, see benchmarks.messenger
+    discord.http.Route.BASE = settings.URL_DISCORD_API
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(
+        settings.URL_DISCORD_GATEWAY
+    )
+
+    if settings.DISCORD_SHARD_COUNT > 1:
+        # one gateway connection per shard, this process runs only shard_ids
+        client: discord.Client = discord.AutoShardedClient(
+            intents=discord.Intents(messages=True, message_content=True),
+            shard_ids=shard_ids,
+            shard_count=settings.DISCORD_SHARD_COUNT,
+        )
+        client.before_identify_hook = identify_wait  # type: ignore
+    else:
+        client = discord.Client(
+            intents=discord.Intents(messages=True, message_content=True)
+        )
+
+    client.event(on_message)
+    client.event(on_raw_bulk_message_delete)
+    client.event(on_raw_message_delete)
+    client.event(on_ready)
 
-client = client_init()
+    return client
 
 
-async def run(exit_event: asyncio.Event | settings.Event) -> None:
+# built by run, so importing this module does not set up a client
+client: discord.Client
+channel_cache: settings.TTL_Cache[Any] = settings.TTL_Cache(
+    settings.CHANNEL_CACHE_SIZE, settings.CHANNEL_CACHE_TTL
+)
+
+
+async def run(
+    exit_event: asyncio.Event | settings.Event | settings.PEvent,
+    shard_ids: list[int] | None = None,
+) -> None:
     global client
 
-    logger.info("DISCORD: Starting")
+    client = client_init(shard_ids)
+
+    logger.info("DISCORD: Starting", shard_ids=shard_ids)
     async with client:
-        asyncio.create_task(client.start(os.environ["DISCORD_TOKEN"]))
+        supervisor.spawn("client", client.start(os.environ["DISCORD_TOKEN"]))
+        supervisor.spawn("scheduler", scheduler.run(exit_event))
+        supervisor.spawn(
+            "metrics",
+            metrics.monitor(
+                "discord" if shard_ids is None else f"discord.{shard_ids[0]}",
+                exit_event,
+            ),
+        )
 
         await exit_event.wait()
 
         logger.info("DISCORD: Stopping")
         await client.close()
+        await supervisor.close()
+        await session_close()
 
 
 async def messages_consume() -> None:
     global client
 
-    while data := await settings.discord_messages.get():
-        logger.info("DISCORD: Processing messages from queue", data=data)
+    while data_list := await settings.discord_messages.get_many():
+        logger.info("DISCORD: Processing messages from queue", data_list=data_list)
 
-        try:
-            channel = await client.fetch_channel(data["channel_id"])
-        except Exception as e:
-            logger.error("DISCORD: Invalid channel", data=data)
-            logger.exception(e)
-            continue
+        # every channel is resolved once per batch, however many replies it gets
+        channel_dict: dict[int, list[dict]] = {}
+        for data in data_list:
+            channel_dict.setdefault(int(data["channel_id"]), []).append(data)
+
+        for channel_id, channel_data_list in channel_dict.items():
+            if (channel := await channel_resolve(channel_id)) is None:
+                logger.error("DISCORD: Invalid channel", data_list=channel_data_list)
+                continue
+
+            for data in channel_data_list:
+                # a partial message is enough to reply to, no need to fetch it
+                await text_send(
+                    data["content"],
+                    reference=channel.get_partial_message(int(data["message_id"])),
+                    lane=Lane.PUSH,
+                )
+
+
+async def blockedornot_fetch(message: discord.Message, argument: str) -> None:
+    await text_send(await meow_blockedornot(argument), reference=message)
+
+
+def channel_bucket(_channel_id: int) -> Token_Bucket:
+    return Token_Bucket(settings.DISCORD_CHANNEL_RATE, settings.DISCORD_CHANNEL_BURST)
+
+
+async def channel_resolve(channel_id: int) -> Any | None:
+    global client
 
+    # the gateway cache costs nothing, the LRU covers what it does not keep
+    if (channel := client.get_channel(channel_id)) is None and (
+        channel := channel_cache.get(channel_id)
+    ) is None:
         try:
-            message = await channel.fetch_message(data["message_id"])  # type: ignore
-        except Exception:
-            logger.info("DISCORD: Unable to find message to reply to", data=data)
-            message = None
+            channel = channel_cache.cache(
+                channel_id, await client.fetch_channel(channel_id)
+            )
+        except (discord.HTTPException, discord.InvalidData):
+            logger.info("DISCORD: Unable to fetch channel", channel_id=channel_id)
+            return None
+
+    return channel if hasattr(channel, "get_partial_message") else None
+
+
+async def fact_fetch(message: discord.Message, _argument: str) -> None:
+    await text_send(await meow_fact(), reference=message)
+
+
+def global_bucket() -> Token_Bucket:
+    # the global limit is per bot, every process sharing it gets a share of it,
+    # and there are never more processes than shards to run in them
+    rate = settings.DISCORD_GLOBAL_RATE / max(
+        min(settings.DISCORD_PROCESSES, settings.DISCORD_SHARD_COUNT), 1
+    )
+
+    return Token_Bucket(rate, rate)
+
+
+async def identify_wait(_shard_id: int | None, *, initial: bool = False) -> None:
+    # every shard in every process takes a turn, the gateway only accepts one
+    # identify per interval, a turn is booked before sleeping until it comes
+    turn = settings.discord_identify.update(
+        lambda last: max(last + settings.DISCORD_IDENTIFY_INTERVAL, monotonic())
+    )
 
-        asyncio.create_task(text_send(data["content"], reference=message))  # type: ignore
+    await asyncio.sleep(turn - monotonic())
 
 
-@client.event
 async def on_message(message: discord.Message) -> None:
+    global client
+
     if message.author == client.user:
         return
 
     logger.info("DISCORD: Received a message", message=message)
 
-    if message_contains(message.content, str(MeowCommand.PETROL)):
-        asyncio.create_task(text_send(await meow_petrol(), reference=message))
+    # direct messages always arrive through shard 0
+    metrics.count(
+        "bigmeow_discord_events_total",
+        event="message",
+        shard=str(message.guild.shard_id if message.guild else 0),
+    )
 
-    elif message_contains(message.content, str(MeowCommand.SAY)):
-        asyncio.create_task(
-            text_send(
-                meow_say(message.content.replace(str(MeowCommand.SAY), "").strip()),
-                reference=message,
-            )
-        )
+    if route := router.match(message.content):
+        handler, argument = route
 
-    elif message_contains(message.content, str(MeowCommand.PROMPT)):
-        await meow_prompt(
-            message.content.replace(str(MeowCommand.PROMPT), "").strip(),
-            channel="discord",
-            destination=json.dumps((message.channel.id, message.id)),
-        )
+        # a prompt answered later over /chat replies into this same channel
+        if handler is prompt_create:
+            channel_cache.cache(message.channel.id, message.channel)
 
-    elif message_contains(message.content, str(MeowCommand.THINK)):
-        asyncio.create_task(
-            text_send(
-                meow_say(
-                    message.content.replace(str(MeowCommand.THINK), "").strip(),
-                    is_cowthink=True,
-                ),
-                reference=message,
-            )
-        )
+        supervisor.spawn(router.name(handler), handler(message, argument))
 
-    elif message_contains(message.content, str(MeowCommand.FACT)):
-        asyncio.create_task(text_send(await meow_fact(), reference=message))
 
-    elif message_contains(message.content, str(MeowCommand.ISBLOCKED)):
-        asyncio.create_task(
-            text_send(
-                await meow_blockedornot(
-                    message.content.replace(str(MeowCommand.ISBLOCKED), "").strip(),
-                ),
-                reference=message,
-            )
-        )
+async def on_raw_bulk_message_delete(
+    payload: discord.RawBulkMessageDeleteEvent,
+) -> None:
+    settings.photo_handle_cache.forget_source(
+        "discord", [str(message_id) for message_id in payload.message_ids]
+    )
 
-    elif message_contains(message.content, "meow", is_command=False):
-        logger.info("DISCORD: Sending a cat photo", message=message)
-        asyncio.create_task(
-            message.channel.send(
-                "photo from https://cataas.com/",
-                file=discord.File(
-                    await meow_fetch_photo(),
-                    description="photo from https://cataas.com/",
-                    filename="meow.png",
-                ),
-                reference=message,
-            )
-        )
+
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent) -> None:
+    # an attachment URL stops working with the message it was uploaded in, and
+    # discord still accepts an embed of it, showing a broken image
+    settings.photo_handle_cache.forget_source("discord", [str(payload.message_id)])
 
 
-@client.event
 async def on_ready() -> None:
     global client
 
     logger.info("DISCORD: Ready for requests")
+    settings.readiness.mark("discord")
 
     if not check_is_debug():
         user = await client.fetch_user(int(os.environ["DISCORD_USER"]))
@@ -146,17 +227,97 @@ async def on_ready() -> None:
             "DISCORD: Sending up message to owner", user=os.environ["DISCORD_USER"]
         )
         if client.user:
-            asyncio.create_task(
-                user.send(f"Bot {client.user.mention} is up\n{meow_say('Hello~')}")
+            scheduler.submit(
+                user.id,
+                partial(
+                    user.send,
+                    f"Bot {client.user.mention} is up\n{meow_say('Hello~')}",
+                ),
+                lane=Lane.PUSH,
             )
 
-    asyncio.create_task(messages_consume())
+    # on_ready fires again after every reconnect, the cap keeps it to one
+    supervisor.spawn("messages_consume", messages_consume())
+
 
+async def petrol_fetch(message: discord.Message, _argument: str) -> None:
+    await text_send(await meow_petrol(), reference=message)
 
-async def text_send(content: str, reference: discord.Message) -> None:
-    asyncio.create_task(
-        reference.channel.send(
+
+async def photo_send(message: discord.Message, _argument: str) -> None:
+    logger.info("DISCORD: Sending a cat photo", message=message)
+
+    if (photo_io := await meow_fetch_photo()) is None:
+        await say_create(message, PHOTO_MISSING)
+        return
+
+    digest, photo = meow_photo_digest(photo_io), photo_io.getvalue()
+
+    scheduler.submit(message.channel.id, partial(photo_upload, message, digest, photo))
+
+
+async def photo_upload(
+    reference: discord.Message, digest: str, photo: bytes
+) -> discord.Message:
+    # a photo uploaded before is embedded from its attachment URL, without the
+    # bytes, the URL is signed and expires, so the handle does as well
+    if url := settings.photo_handle_cache.get(digest, "discord"):
+        return await reference.channel.send(
+            "photo from https://cataas.com/",
+            embed=discord.Embed().set_image(url=url),
             reference=reference,
+        )
+
+    # the file is built per attempt, discord closes it once the request is done
+    message = await reference.channel.send(
+        "photo from https://cataas.com/",
+        file=discord.File(
+            BytesIO(photo),
+            description="photo from https://cataas.com/",
+            # normalized photos are JPEG, whatever the upstream sent
+            filename="meow.jpg" if photo.startswith(b"\xff\xd8\xff") else "meow.png",
+        ),
+        reference=reference,
+    )
+
+    if message.attachments:
+        settings.photo_handle_cache.cache(
+            digest, "discord", message.attachments[0].url, str(message.id)
+        )
+
+    return message
+
+
+async def prompt_create(message: discord.Message, argument: str) -> None:
+    await meow_prompt(
+        argument,
+        channel="discord",
+        destination=json.dumps((message.channel.id, message.id)),
+    )
+
+
+def retry_after(exception: Exception) -> float | None:
+    # discord.py retries 429s on its own, this only sees the ones it gave up on
+    return (
+        retry_seconds(exception.response.headers.get("Retry-After", 1))
+        if isinstance(exception, discord.HTTPException) and exception.status == 429
+        else None
+    )
+
+
+async def say_create(message: discord.Message, argument: str) -> None:
+    await text_send(meow_say(argument), reference=message)
+
+
+async def text_send(
+    content: str,
+    reference: discord.Message | discord.PartialMessage,
+    lane: Lane = Lane.INTERACTIVE,
+) -> None:
+    scheduler.submit(
+        reference.channel.id,
+        lambda: reference.channel.send(
+            reference=reference.to_reference(fail_if_not_exists=False),
             **(
                 {
                     "file": discord.File(
@@ -167,5 +328,33 @@ async def text_send(content: str, reference: discord.Message) -> None:
                 if len(content) > 2000
                 else {"content": content}
             ),  # type: ignore
-        )
-    )
\ No newline at end of file
+        ),
+        lane=lane,
+        key=(
+            (reference.channel.id, reference.id, content) if lane == Lane.PUSH else None
+        ),
+    )
+
+
+async def think_create(message: discord.Message, argument: str) -> None:
+    await text_send(meow_say(argument, is_cowthink=True), reference=message)
+
+
+supervisor = Task_Supervisor("discord")
+scheduler = Send_Scheduler(
+    "discord",
+    global_bucket(),
+    channel_bucket,
+    retry_after,
+)
+router = Command_Router(
+    {
+        MeowCommand.FACT: fact_fetch,
+        MeowCommand.ISBLOCKED: blockedornot_fetch,
+        MeowCommand.PETROL: petrol_fetch,
+        MeowCommand.PROMPT: prompt_create,
+        MeowCommand.SAY: say_create,
+        MeowCommand.THINK: think_create,
+    },
+    fallback=photo_send,
+)
@@ -0,0 +1,345 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import time
+from statistics import quantiles
+from typing import Any
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BOT_ID = 4242
+TEXTS = (
+    "meow",
+    "!meowfact",
+    "!meowisblocked example.com",
+    "!meowpetrol",
+    "!meowsay hello",
+    "!meowthink hello",
+)
+
+
+class Telegram_API:
+    # a Bot API sink, it answers just enough methods to keep the bot going and
+    # resolves a future for every reply it was told to expect
+    def __init__(self) -> None:
+        self.reply_dict: dict[tuple[int, int], asyncio.Future] = {}
+        self.ready = asyncio.Event()
+        self.message_id = itertools.count(1)
+
+        # bytes of every photo the bot uploaded, rather than sent by file_id
+        self.upload_bytes = 0
+
+        # updates handed out by getUpdates, for bots that poll instead
+        self.update_queue: asyncio.Queue[dict] = asyncio.Queue()
+
+    def app_create(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.method_post)
+
+        return app
+
+    def expect(self, chat_id: int, message_id: int) -> asyncio.Future:
+        future = self.reply_dict[(chat_id, message_id)] = (
+            asyncio.get_running_loop().create_future()
+        )
+
+        return future
+
+    async def method_post(self, request: web.Request) -> web.Response:
+        method, data = request.match_info["method"], dict(await request.post())
+
+        match method:
+            case "getMe":
+                result: Any = {
+                    "id": BOT_ID,
+                    "is_bot": True,
+                    "first_name": "BigMeow",
+                    "username": "bigmeow_bot",
+                    "can_join_groups": True,
+                    "can_read_all_group_messages": False,
+                    "supports_inline_queries": False,
+                }
+
+            case "setWebhook" | "deleteWebhook":
+                self.ready.set()
+                result = True
+
+            case "getUpdates":
+                result = await self.updates_get(
+                    int(data.get("limit", 100)), float(data.get("timeout", 0))
+                )
+
+            case "sendMessage" | "sendPhoto":
+                chat_id = int(data["chat_id"])
+                reply_to = json.loads(data.get("reply_parameters", "{}")).get(
+                    "message_id", data.get("reply_to_message_id", 0)
+                )
+
+                if future := self.reply_dict.pop((chat_id, int(reply_to)), None):
+                    future.done() or future.set_result(time.perf_counter())
+
+                result = message_create(next(self.message_id), chat_id)
+
+                if isinstance(photo := data.get("photo"), web.FileField):
+                    self.upload_bytes += len(photo.file.read())
+                    result["photo"] = [
+                        {
+                            "file_id": f"photo{result['message_id']}",
+                            "file_unique_id": f"photo{result['message_id']}",
+                            "width": 512,
+                            "height": 512,
+                        }
+                    ]
+
+            case _:
+                result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def updates_get(self, limit: int, timeout: float) -> list[dict]:
+        # a long poll, waits for the first update then takes what else is there
+        try:
+            update_list = [
+                await asyncio.wait_for(self.update_queue.get(), timeout=timeout)
+            ]
+        except asyncio.TimeoutError:
+            return []
+
+        while len(update_list) < limit and not self.update_queue.empty():
+            update_list.append(self.update_queue.get_nowait())
+
+        return update_list
+
+
+class Load_Generator:
+    def __init__(
+        self,
+        url: str,
+        sink: Telegram_API,
+        secret: str,
+        update_list: list[dict] | None = None,
+        chat_ratio: float = 0.0,
+        timeout: float = 30,
+    ) -> None:
+        self.url, self.sink, self.secret = url, sink, secret
+        self.update_list = update_list or [
+            update_create(0, 0, 0, text) for text in TEXTS
+        ]
+        self.chat_ratio, self.timeout = chat_ratio, timeout
+
+        # every request comes from a chat of its own, so the per-chat send
+        # limits of the bot never get in the way
+        self.id_count = itertools.count(10_000)
+
+    async def run(self, rate: float, duration: float, concurrency: int) -> dict:
+        ack_list, reply_list = [], []
+        counter = {"sent": 0, "rejected": 0, "dropped": 0, "timeouts": 0}
+        pending = 0
+
+        async def once(session: aiohttp.ClientSession, update: dict) -> None:
+            nonlocal pending
+
+            chat_id, message_id = next(self.id_count), next(self.id_count)
+            reply = self.sink.expect(chat_id, message_id)
+            started, is_acked = time.perf_counter(), False
+
+            try:
+                async with self.request(
+                    session, update, chat_id, message_id
+                ) as response:
+                    await response.read()
+
+                ack_list.append(time.perf_counter() - started)
+                pending, is_acked = pending - 1, True
+
+                if response.status >= 300:
+                    counter["rejected"] += 1
+                    return
+
+                reply_list.append(
+                    await asyncio.wait_for(reply, timeout=self.timeout) - started
+                )
+            except asyncio.TimeoutError:
+                counter["timeouts"] += 1
+            except aiohttp.ClientError:
+                counter["rejected"] += 1
+            finally:
+                # a request that failed or timed out before its ack gives its
+                # slot back too, aiohttp timeouts are TimeoutErrors as well
+                if not is_acked:
+                    pending -= 1
+
+                self.sink.reply_dict.pop((chat_id, message_id), None)
+
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency)
+        ) as session:
+            task_list, started = [], time.perf_counter()
+
+            # open loop, requests go out on schedule whether or not the ones
+            # before them were answered, up to concurrency waiting for an ack
+            for idx in range(int(rate * duration)):
+                if (delay := started + idx / rate - time.perf_counter()) > 0:
+                    await asyncio.sleep(delay)
+
+                if pending >= concurrency:
+                    counter["dropped"] += 1
+                    continue
+
+                pending += 1
+                counter["sent"] += 1
+                task_list.append(
+                    asyncio.create_task(once(session, random.choice(self.update_list)))
+                )
+
+            await asyncio.gather(*task_list)
+            elapsed = time.perf_counter() - started
+
+        return {
+            **counter,
+            "ack_rps": len(ack_list) / elapsed,
+            "reply_rps": len(reply_list) / elapsed,
+            "ack_p50_ms": percentile(ack_list, 50) * 1000,
+            "ack_p99_ms": percentile(ack_list, 99) * 1000,
+            "reply_p50_ms": percentile(reply_list, 50) * 1000,
+            "reply_p95_ms": percentile(reply_list, 95) * 1000,
+            "reply_p99_ms": percentile(reply_list, 99) * 1000,
+        }
+
+    def request(
+        self,
+        session: aiohttp.ClientSession,
+        update: dict,
+        chat_id: int,
+        message_id: int,
+    ):
+        text = update.get("message", {}).get("text") or "meow"
+
+        if random.random() < self.chat_ratio:
+            return session.post(
+                f"{self.url}/chat",
+                data=text.encode(),
+                headers={
+                    "X-Channel": "telegram",
+                    "X-Destination": json.dumps((chat_id, message_id)),
+                },
+            )
+
+        return session.post(
+            f"{self.url}/telegram",
+            json=update_rewrite(update, next(self.id_count), chat_id, message_id),
+            headers={"X-Telegram-Bot-Api-Secret-Token": self.secret},
+        )
+
+
+def message_create(message_id: int, chat_id: int, text: str = "") -> dict:
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Loadgen"},
+        "text": text,
+    }
+
+
+def percentile(samples: list[float], pct: int) -> float:
+    if len(samples) < 2:
+        return samples[0] if samples else 0.0
+
+    return quantiles(samples, n=100, method="inclusive")[pct - 1]
+
+
+def update_create(update_id: int, chat_id: int, message_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": message_create(message_id, chat_id, text),
+    }
+
+
+def update_rewrite(update: dict, update_id: int, chat_id: int, message_id: int) -> dict:
+    message = update.get("message", {})
+
+    return {
+        **update,
+        "update_id": update_id,
+        "message": {
+            **message,
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {**message.get("chat", {"type": "private"}), "id": chat_id},
+        },
+    }
+
+
+async def sink_serve(sink: Telegram_API, port: int) -> web.AppRunner:
+    runner = web.AppRunner(sink.app_create(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    return runner
+
+
+async def run(args: argparse.Namespace) -> None:
+    sink = Telegram_API()
+    runner = await sink_serve(sink, args.sink_port)
+
+    update_list = None
+    if args.updates:
+        with open(args.updates) as updates:
+            update_list = [json.loads(line) for line in updates if line.strip()]
+
+    generator = Load_Generator(
+        args.url, sink, args.secret, update_list, args.chat_ratio, args.timeout
+    )
+
+    try:
+        for rate in args.rate:
+            result = await generator.run(rate, args.duration, args.concurrency)
+
+            print(
+                f"rate={rate:<8g}",
+                "  ".join(
+                    (
+                        f"{key}={value:.3f}"
+                        if isinstance(value, float)
+                        else f"{key}={value}"
+                    )
+                    for key, value in result.items()
+                ),
+                flush=True,
+            )
+    finally:
+        await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Replays webhook traffic against a running bigmeow web tier"
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument(
+        "--rate",
+        type=lambda value: [float(rate) for rate in value.split(",")],
+        default=[10.0],
+        help="requests per second, a comma separated list steps through each",
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--chat-ratio", type=float, default=0.0)
+    parser.add_argument("--updates", help="recorded updates, one JSON per line")
+    parser.add_argument("--sink-port", type=int, default=8081)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--secret", default=os.environ.get("WEB_TELEGRAM_TOKEN", ""))
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
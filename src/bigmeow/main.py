@@ -1,22 +1,33 @@
+import argparse
 import asyncio
+import importlib
 import multiprocessing
 import signal
-import threading
+import subprocess
+import sys
 from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from functools import partial
+from typing import Callable, Coroutine
 
 import structlog
 from dotenv import load_dotenv
 
 import bigmeow.settings as settings
-from bigmeow.discord import run as discord_run
-from bigmeow.telegram import run as telegram_run
-from bigmeow.web import run as web_run
+from bigmeow.common import loop_run, session_close, web_workers_count
+from bigmeow.meow import meow_photo_close, meow_photo_prefetch, meow_warm
 
 load_dotenv()
 
 logger = structlog.get_logger()
 
+# modules each process role imports on top of this one, anything every role
+# needs is imported here, before the pool forks
+ROLE_DICT = {
+    "bot": ("bigmeow.telegram", "bigmeow.discord"),
+    "discord": ("bigmeow.discord",),
+    "web": ("bigmeow.web",),
+}
+
 
 def done_handler(
     future: Future,
@@ -45,31 +56,81 @@ def shutdown_handler(
 
 
 def multiprocess_setup() -> None:
-    settings.cat_lock = settings.Lock(threading.Lock())
-    settings.fact_lock = settings.Lock(threading.Lock())
-    settings.latest_lock = settings.Lock(threading.Lock())
+    # caches live in shared memory already, this only stops two processes
+    # from refreshing the fuel price list at the same time, a single loop
+    # running every frontend gets by with the asyncio lock
+    if settings.BOT_RUNTIME != "loop" or settings.DISCORD_PROCESSES > 0:
+        settings.latest_lock = settings.Lock(multiprocessing.Lock())
+
+
+async def bot_loop_run(
+    pexit_event: settings.PEvent, run_dict: dict[str, Callable[..., Coroutine]]
+) -> None:
+    # every frontend shares this loop, so a plain asyncio.Event will do
+    exit_event = asyncio.Event()
+    task_dict = {
+        asyncio.create_task(func(exit_event)): name for name, func in run_dict.items()
+    }
+    pexit_task = asyncio.create_task(pexit_event.wait())
+
+    logger.info("MAIN: Tasks are started in one loop", name_list=list(run_dict))
+    done_set, _ = await asyncio.wait(
+        {pexit_task, *task_dict}, return_when=asyncio.FIRST_COMPLETED
+    )
+
+    for task in done_set - {pexit_task}:
+        logger.info(
+            "MAIN: Task is done, prompting others to quit", name=task_dict[task]
+        )
+
+        if not task.cancelled() and task.exception() is not None:
+            logger.exception(task.exception())
+
+    logger.info("MAIN: Sending exit event to all tasks in loop")
+    exit_event.set()
+    pexit_task.cancel()
 
-    settings.telegram_updates = settings.PQueue(multiprocessing.Queue())
-    settings.discord_messages = settings.PQueue(multiprocessing.Queue())
-    settings.telegram_messages = settings.PQueue(multiprocessing.Queue())
+    await asyncio.gather(*task_dict, return_exceptions=True)
+
+    # each frontend closes the session on its way out, and a slower one may
+    # have opened it again since
+    await session_close()
 
 
 async def bot_run(pexit_event: settings.PEvent) -> None:
+    # imported here, so web workers never load the bot frameworks
+    from bigmeow.telegram import run as telegram_run
+
+    run_dict: dict[str, Callable[..., Coroutine]] = {"bot.telegram": telegram_run}
+
+    # unless the shards have processes of their own
+    if settings.DISCORD_PROCESSES == 0:
+        from bigmeow.discord import run as discord_run
+
+        run_dict["bot.discord"] = discord_run
+
+    run_dict["bot.prefetch"] = prefetch_run
+
+    match settings.BOT_RUNTIME:
+        case "threads":
+            await bot_threads_run(pexit_event, run_dict)
+
+        case "loop":
+            await bot_loop_run(pexit_event, run_dict)
+
+        case _:
+            raise ValueError(f"Invalid BOT_RUNTIME {settings.BOT_RUNTIME}")
+
+
+async def bot_threads_run(
+    pexit_event: settings.PEvent, run_dict: dict[str, Callable[..., Coroutine]]
+) -> None:
+    # a loop per thread, they signal each other through settings.Event
     exit_event = settings.Event()
 
     with ThreadPoolExecutor(max_workers=10) as executor:
-        task_submit(
-            executor,
-            exit_event,
-            "bot.telegram",
-            lambda: asyncio.run(telegram_run(exit_event)),
-        )
-        task_submit(
-            executor,
-            exit_event,
-            "bot.discord",
-            lambda: asyncio.run(discord_run(exit_event)),
-        )
+        for name, func in run_dict.items():
+            task_submit(executor, exit_event, name, loop_run, func(exit_event))
 
         await pexit_event.wait()
 
@@ -77,8 +138,92 @@ async def bot_run(pexit_event: settings.PEvent) -> None:
         exit_event.set()
 
 
-def process_run(func, pexit_event: settings.PEvent) -> None:
-    asyncio.run(func(pexit_event))
+async def prefetch_run(exit_event: asyncio.Event | settings.Event) -> None:
+    # the warm up returns once every cache is filled, the prefetch keeps going
+    await asyncio.gather(meow_warm(exit_event), meow_photo_prefetch(exit_event))
+
+
+def process_run(func, pexit_event: settings.PEvent, *args) -> None:
+    try:
+        loop_run(func(pexit_event, *args))
+    finally:
+        meow_photo_close()
+
+
+async def shard_run(pexit_event: settings.PEvent, shard_ids: list[int]) -> None:
+    # imported here, so only the processes running shards load discord
+    from bigmeow.discord import run
+
+    # the cat pool belongs to the process, a fresh one so its drained event
+    # is not the pipe inherited from the bot, the caches stay shared
+    settings.cat_pool = settings.Cat_Pool(settings.CAT_POOL_SIZE, settings.CAT_POOL_TTL)
+
+    await asyncio.gather(run(pexit_event, shard_ids), meow_photo_prefetch(pexit_event))
+
+
+def shard_slices(count: int, processes: int) -> list[list[int]]:
+    # contiguous ranges of shard ids, as even as they divide
+    processes = min(processes, count)
+
+    return [
+        list(range(count * index // processes, count * (index + 1) // processes))
+        for index in range(processes)
+    ]
+
+
+def startup_imports(importtime: str) -> dict[str, tuple[int, list[tuple[str, int]]]]:
+    # -X importtime lists every module after the ones it imported, nested ones
+    # indented, this keeps each top level module with its direct imports
+    result, child_list = {}, []
+
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _self, cumulative, name = line.removeprefix("import time:").split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+
+        if depth == 0:
+            result[name.strip()] = (int(cumulative), child_list)
+            child_list = []
+
+        elif depth == 1:
+            child_list.append((name.strip(), int(cumulative)))
+
+    return result
+
+
+def startup_profile(top: int) -> None:
+    # each role is imported in a fresh interpreter after this module, the way
+    # a forked process would, import times are in microseconds
+    for role, module_list in {"main": ("bigmeow.main",), **ROLE_DICT}.items():
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                "; ".join(f"import {name}" for name in ("bigmeow.main", *module_list)),
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            print(result.stderr, file=sys.stderr)
+            continue
+
+        import_dict = startup_imports(result.stderr)
+        total, child_list = 0, []
+        for name in module_list:
+            cumulative, name_child_list = import_dict.get(name, (0, []))
+            total, child_list = total + cumulative, child_list + name_child_list
+
+        print(
+            f"{role}: {total / 1000:.1f}ms"
+            + ("" if role == "main" else " on top of main")
+        )
+        for name, cumulative in sorted(child_list, key=lambda item: -item[1])[:top]:
+            print(f"  {cumulative / 1000:>8.1f}ms  {name}")
 
 
 def task_submit(
@@ -107,18 +252,75 @@ def task_submit(
     return future
 
 
+async def web_run(pexit_event: settings.PEvent, worker: int) -> None:
+    # imported here, so the bot process never loads the web framework
+    from bigmeow.web import run
+
+    await run(pexit_event, worker)
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="report import times of each process role and exit",
+    )
+    parser.add_argument("--profile-top", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        startup_profile(args.profile_top)
+        return
+
     multiprocess_setup()
 
-    manager = multiprocessing.Manager()
-    pexit_event = settings.PEvent(manager.Event())
+    pexit_event = settings.PEvent()
+
+    web_workers = web_workers_count()
+    shard_list = shard_slices(settings.DISCORD_SHARD_COUNT, settings.DISCORD_PROCESSES)
 
-    with ProcessPoolExecutor(max_workers=3) as executor:
+    # a role running in several processes is imported once, before the pool
+    # forks, rather than once in every worker
+    for role, processes in (("web", web_workers), ("discord", len(shard_list))):
+        if processes > 1:
+            for name in ROLE_DICT[role]:
+                importlib.import_module(name)
+
+    # forked, the shared caches, queues, events and metrics slots are only
+    # shared with children that inherit their memory and file descriptors
+    with ProcessPoolExecutor(
+        max_workers=1 + web_workers + len(shard_list),
+        mp_context=multiprocessing.get_context("fork"),
+    ) as executor:
         for s in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
             signal.signal(s, partial(shutdown_handler, exit_event=pexit_event))
 
         task_submit(executor, pexit_event, "bot", process_run, bot_run, pexit_event)
-        task_submit(executor, pexit_event, "web", process_run, web_run, pexit_event)
+
+        # all web workers feed the same queues into the bot process
+        for worker in range(web_workers):
+            task_submit(
+                executor,
+                pexit_event,
+                f"web.{worker}",
+                process_run,
+                web_run,
+                pexit_event,
+                worker,
+            )
+
+        # every shard process consumes the same discord_messages queue
+        for shard_ids in shard_list:
+            task_submit(
+                executor,
+                pexit_event,
+                f"discord.{shard_ids[0]}",
+                process_run,
+                shard_run,
+                pexit_event,
+                shard_ids,
+            )
 
 
 if __name__ == "__main__":
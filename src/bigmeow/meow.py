@@ -1,22 +1,42 @@
+import asyncio
+import contextlib
 import csv
+import hashlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import date, timedelta
-from functools import reduce
-from io import BytesIO, StringIO
+from functools import cache
+from io import BytesIO
+from math import ceil
 from os import environ
 from random import choice
-from typing import Callable
+from time import monotonic
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit
 
 import aiohttp
 import structlog
-from cowsay import cowsay, cowthink
+from cowsay import THOUGHT_OPTIONS, Option, get_cow, make_bubble
 from dotenv import load_dotenv
 
 from bigmeow import settings
+from bigmeow.common import session_close, session_get
+from bigmeow.metrics import metrics
+from bigmeow.photo import photo_normalize
 from bigmeow.settings import Change, Latest, Level
 
 load_dotenv()
 logger = structlog.get_logger()
 
+FACT_MISSING = "No cat fact at the moment, meow again later"
+PHOTO_MISSING = "No cat photo at the moment, meow again later"
+
+# started by the first photo to normalize, in whichever process needs it
+photo_executor: ProcessPoolExecutor | None = None
+photo_lock = threading.Lock()
+
 
 def meow_sayify(func: Callable) -> Callable:
     async def wrapped_function(*args, **kwargs) -> str:
@@ -25,12 +45,32 @@ def meow_sayify(func: Callable) -> Callable:
     return wrapped_function
 
 
-@meow_sayify
 async def meow_blockedornot(query: str) -> str:
-    url = "https://blockedornot.sinarproject.org/api/"
+    domain = meowblocked_normalize(query)
+
+    if (result := settings.blocked_cache.get(domain)) is None:
+        # concurrent lookups of the same domain share one upstream request
+        result = await settings.blocked_flight.run(
+            domain, lambda: meowblocked_fetch(domain)
+        )
+
+    return result
+
+
+def meowblocked_cache(func: Callable) -> Callable:
+    async def wrapped_function(domain: str) -> str:
+        return settings.blocked_cache.cache(domain, await func(domain))
+
+    return wrapped_function
+
+
+@meowblocked_cache
+@meow_sayify
+async def meowblocked_fetch(query: str) -> str:
+    url = settings.URL_BLOCKEDORNOT
 
     logger.info("MEOW: Fetching blocked query", url=url, query=query)
-    async with aiohttp.request("GET", url, params={"query": query}) as response:
+    async with session_get().get(url, params={"query": query}) as response:
         result = [f"Website {query} is safe."]
 
         response_data = await response.json()
@@ -47,6 +87,97 @@ async def meow_blockedornot(query: str) -> str:
         return "\n".join(result + ["Powered by https://blockedornot.sinarproject.org/"])
 
 
+def meowblocked_normalize(query: str) -> str:
+    query = query.strip().lower()
+
+    return (
+        urlsplit(query if "://" in query else f"//{query}").hostname or query
+    ).rstrip(".")
+
+
+async def meowfact_fetch() -> str | None:
+    url = settings.URL_FACT
+
+    logger.info("MEOW: Fetching a cat fact", url=url)
+    try:
+        async with session_get().get(url) as response:
+            if response.status != 200:
+                return None
+
+            response_data = await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+        logger.error("MEOW: Unable to fetch a cat fact", url=url, exc_info=exception)
+        return None
+
+    return settings.fact_cache.cache(
+        f'{response_data.get("data")[0]}\n    - https://github.com/wh-iterabb-it/meowfacts'
+    )
+
+
+async def meowpetrol_fetch(url: str, current: Latest) -> Latest:
+    source, headers = settings.latest_source.load(), {}
+
+    # validators only apply to the rows already held in current
+    if source.etag and current.level.date > date.min:
+        headers["If-None-Match"] = source.etag
+    if source.last_modified and current.level.date > date.min:
+        headers["If-Modified-Since"] = source.last_modified
+    if source.fieldnames:
+        # the newest rows are appended to the end, only the tail is needed
+        headers["Range"] = f"bytes=-{settings.PETROL_TAIL_SIZE}"
+
+    logger.info("MEOW: Fetching the fuel price list", url=url, headers=headers)
+    async with session_get().get(url, headers=headers) as response:
+        if response.status == 304:
+            logger.info("MEOW: Fuel price list is not modified", url=url)
+            return current
+
+        elif response.status not in (200, 206):
+            logger.error(
+                "MEOW: Unable to fetch the fuel price list",
+                url=url,
+                status=response.status,
+            )
+            return current
+
+        lines = aiter(response.content)
+
+        if response.status == 206:
+            # the range most likely starts in the middle of a row
+            await anext(lines, b"")
+            fieldnames = source.fieldnames
+        else:
+            fieldnames = tuple(next(csv.reader([(await anext(lines)).decode()])))
+
+        async for line in lines:
+            if line.strip():
+                current = meowpetrol_update_latest(
+                    current,
+                    meowpetrol_parse_row(
+                        dict(zip(fieldnames, next(csv.reader([line.decode()]))))
+                    ),
+                )
+
+        settings.latest_source.store(
+            settings.Latest_Source(
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                fieldnames,
+            )
+        )
+
+    return current
+
+
+def meowpetrol_parse_row(row: dict[str, str]) -> Level | Change:
+    return (Level if row["series_type"] == "level" else Change)(
+        date.fromisoformat(row["date"]),
+        float(row["ron95"]),
+        float(row["ron97"]),
+        float(row["diesel"]),
+    )
+
+
 def meowpetrol_update_latest(current: Latest, incoming: Level | Change) -> Latest:
     field = None
 
@@ -62,95 +193,274 @@ def meowpetrol_update_latest(current: Latest, incoming: Level | Change) -> Lates
 
 @meow_sayify
 async def meow_fact() -> str:
-    url = "https://meowfacts.herokuapp.com/"
-
-    logger.info("MEOW: Fetching a cat fact", url=url)
-    async with aiohttp.request("GET", url) as response:
-        response_data = await response.json()
-
-        async with settings.fact_lock:
-            return (
-                settings.fact_cache.cache(
-                    f'{response_data.get("data")[0]}\n    - https://github.com/wh-iterabb-it/meowfacts'
-                )
-                if response.status == 200
-                else settings.fact_cache.get()
-            )
+    return await meowfact_fetch() or settings.fact_cache.get() or FACT_MISSING
 
 
 @meow_sayify
 async def meow_petrol() -> str:
-    url = "https://storage.data.gov.my/commodities/fuelprice.csv"
+    url = settings.URL_PETROL
 
     async with settings.latest_lock:
-        if (settings.latest_cache.level.date + timedelta(days=6)) < date.today():
-            logger.info("MEOW: Fetching the fuel price list", url=url)
-            async with aiohttp.request("GET", url) as response:
-                settings.latest_cache = reduce(
-                    meowpetrol_update_latest,
-                    [
-                        Level(
-                            date.fromisoformat(row["date"]),
-                            float(row["ron95"]),
-                            float(row["ron97"]),
-                            float(row["diesel"]),
-                        )
-                        if row["series_type"] == "level"
-                        else Change(
-                            date.fromisoformat(row["date"]),
-                            float(row["ron95"]),
-                            float(row["ron97"]),
-                            float(row["diesel"]),
-                        )
-                        for row in csv.DictReader(StringIO(await response.text()))
-                    ],
-                    settings.latest_cache,
-                )
+        latest = settings.latest_cache.load()
+
+        if (latest.level.date + timedelta(days=6)) < date.today():
+            metrics.count("bigmeow_cache_requests_total", cache="petrol", result="miss")
+
+            latest = await meowpetrol_fetch(url, latest)
+            settings.latest_cache.store(latest)
+        else:
+            metrics.count("bigmeow_cache_requests_total", cache="petrol", result="hit")
 
         return "\n\n".join(
             (
                 f"Data sourced from {url}",
-                f"From {settings.latest_cache.level.date.strftime(settings.DATE_FORMAT)} to "
-                f"{(settings.latest_cache.level.date + timedelta(days=6)).strftime(settings.DATE_FORMAT)}",
+                f"From {latest.level.date.strftime(settings.DATE_FORMAT)} to "
+                f"{(latest.level.date + timedelta(days=6)).strftime(settings.DATE_FORMAT)}",
             )
             + tuple(
                 "Price of {} is RM {} per litre ({} from last week)".format(
                     {"ron95": "RON 95", "ron97": "RON 97", "diesel": "diesel"}.get(
                         field
                     ),
-                    getattr(settings.latest_cache.level, field),
-                    "{:+0.2f}".format(getattr(settings.latest_cache.change, field)),
+                    getattr(latest.level, field),
+                    "{:+0.2f}".format(getattr(latest.change, field)),
                 )
                 for field in ("ron95", "ron97", "diesel")
             )
         )
 
 
-async def meow_fetch_photo() -> BytesIO:
-    url = "https://cataas.com/cat/says/meow?type=square"
+async def meow_download_photo() -> BytesIO | None:
+    url = settings.URL_CATAAS
 
     logger.info("MEOW: Fetching a cat photo", url=url)
-    async with aiohttp.request("GET", url) as response:
-        async with settings.cat_lock:
-            return (
-                settings.cat_cache.cache(BytesIO(await response.read()))
-                if response.status == 200
-                else settings.cat_cache.get()
+    async with session_get().get(url) as response:
+        if response.status != 200:
+            return None
+
+        photo = BytesIO(await response.read())
+
+    # once per new photo, the pool and the cache only ever see the result
+    return await meow_photo_normalize(photo)
+
+
+async def meow_fetch_photo() -> BytesIO | None:
+    if (photo := settings.cat_pool.get()) is None:
+        try:
+            photo = await meow_download_photo()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+            logger.error("MEOW: Unable to fetch a cat photo", exc_info=exception)
+
+    # None only when the upstream failed before a single photo was cached
+    return settings.cat_cache.cache(photo) if photo else settings.cat_cache.get()
+
+
+def meow_photo_close() -> None:
+    global photo_executor
+
+    # the workers are children of this process, they have to go before it does
+    with photo_lock:
+        if photo_executor is not None:
+            photo_executor.shutdown(cancel_futures=True)
+            photo_executor = None
+
+
+def meow_photo_digest(photo: BytesIO) -> str:
+    # a photo gets the same digest whichever process or cache it came from
+    return hashlib.blake2b(photo.getbuffer(), digest_size=16).hexdigest()
+
+
+@cache
+def meow_photo_is_pillow() -> bool:
+    # checked once per process, rather than warning about every new photo
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        logger.warning("MEOW: Pillow is not installed, caching photos as they are")
+        return False
+
+    return True
+
+
+async def meow_photo_normalize(photo: BytesIO) -> BytesIO:
+    global photo_executor
+
+    size = photo.getbuffer().nbytes
+    metrics.count("bigmeow_photo_bytes_total", size, stage="downloaded")
+
+    if settings.PHOTO_BUDGET <= 0 or size <= settings.PHOTO_BUDGET:
+        metrics.count("bigmeow_photo_bytes_total", size, stage="normalized")
+        return photo
+
+    if not meow_photo_is_pillow():
+        metrics.count("bigmeow_photo_bytes_total", size, stage="normalized")
+        return photo
+
+    with photo_lock:
+        if photo_executor is None:
+            # spawned, forking a process with a loop on every thread is unsafe
+            photo_executor = ProcessPoolExecutor(
+                max_workers=settings.PHOTO_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+        executor = photo_executor
+
+    try:
+        payload = await asyncio.get_running_loop().run_in_executor(
+            executor,
+            photo_normalize,
+            photo.getvalue(),
+            settings.PHOTO_BUDGET,
+            settings.PHOTO_DIMENSION,
+        )
+    except BrokenProcessPool as exception:
+        logger.error("MEOW: Photo workers are gone, restarting", exc_info=exception)
+        meow_photo_close()
+        payload = photo.getvalue()
+    except Exception as exception:
+        logger.error("MEOW: Unable to normalize a cat photo", exc_info=exception)
+        payload = photo.getvalue()
+
+    logger.info("MEOW: Cat photo normalized", size=size, normalized=len(payload))
+    metrics.count("bigmeow_photo_bytes_total", len(payload), stage="normalized")
+
+    return BytesIO(payload)
+
+
+async def meow_photo_prefetch(exit_event: asyncio.Event | settings.Event) -> None:
+    pool, latency = settings.cat_pool, 1.0
+
+    logger.info("MEOW: Starting cat photo prefetch", size=pool.size)
+    while not exit_event.is_set():
+        pool.drained.clear()
+
+        if deficit := pool.deficit():
+            # fetch enough in parallel to cover what drains during one round,
+            # or everything at once when the pool has run dry
+            concurrency = max(
+                1,
+                min(
+                    deficit,
+                    settings.CAT_POOL_CONCURRENCY,
+                    ceil(pool.drain_rate() * latency) if pool.photo_list else deficit,
+                ),
+            )
+
+            started = monotonic()
+            photo_list = await asyncio.gather(
+                *(meow_download_photo() for _ in range(concurrency)),
+                return_exceptions=True,
             )
+            latency = monotonic() - started
+
+            for photo in photo_list:
+                if isinstance(photo, BytesIO):
+                    pool.put(photo)
+                elif isinstance(photo, Exception):
+                    logger.error("MEOW: Unable to prefetch a cat photo", exc_info=photo)
+
+            logger.info("MEOW: Cat photo pool refilled", **pool.stats())
+
+            if not any(isinstance(photo, BytesIO) for photo in photo_list):
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(
+                        exit_event.wait(), timeout=settings.CAT_POOL_BACKOFF
+                    )
+
+            continue
+
+        pending = {
+            asyncio.create_task(pool.drained.wait()),
+            asyncio.create_task(exit_event.wait()),
+        }
+        _, pending = await asyncio.wait(
+            pending, timeout=pool.ttl, return_when=asyncio.FIRST_COMPLETED
+        )
+
+        for task in pending:
+            task.cancel()
+
+    logger.info("MEOW: Stopping cat photo prefetch", **pool.stats())
+    await session_close()
 
 
 async def meow_prompt(message: str, channel: str, destination: str) -> None:
-    url = f"https://maker.ifttt.com/trigger/prompt/with/key/{environ.get('IFTTT_KEY')}"
+    url = settings.URL_IFTTT.format(key=environ.get("IFTTT_KEY"))
     data = {"value1": message, "value2": channel, "value3": destination}
 
     logger.info("MEOW: Sending IFTTT request", ifttt_event="prompt", data=data)
-    async with aiohttp.request("POST", url, json=data) as response:
+    async with session_get().post(url, json=data) as response:
         logger.info("MEOW: IFTTT response", response=await response.text())
 
 
-def meow_say(message: str, is_cowthink: bool = False, wrap_text: bool = True) -> str:
-    func = cowthink if is_cowthink else cowsay
+async def meow_warm(exit_event: asyncio.Event | settings.Event) -> None:
+    async def cat() -> bool:
+        if photo := await meow_download_photo():
+            settings.cat_cache.cache(photo)
+
+        return photo is not None
+
+    async def fact() -> bool:
+        return await meowfact_fetch() is not None
+
+    async def petrol() -> bool:
+        await meow_petrol()
+
+        return settings.latest_cache.load().level.date > date.min
+
+    # every cache is filled at once, so the bot is ready as soon as the
+    # slowest upstream answers, rather than after all of them in turn
+    logger.info("MEOW: Warming up caches")
+    await asyncio.gather(
+        meow_warm_step("cat", cat, exit_event),
+        meow_warm_step("fact", fact, exit_event),
+        meow_warm_step("petrol", petrol, exit_event),
+    )
+
+
+async def meow_warm_step(
+    step: str,
+    func: Callable[[], Awaitable[bool]],
+    exit_event: asyncio.Event | settings.Event,
+) -> None:
+    while not exit_event.is_set():
+        try:
+            if await func():
+                settings.readiness.mark(step)
+                return
+        except Exception as exception:
+            logger.error(
+                "MEOW: Unable to warm up a cache", step=step, exc_info=exception
+            )
 
-    return "```\n{}\n```".format(
-        func(message, wrap_text=wrap_text, cow=choice(["kitty", "hellokitty", "meow"]))
-    )
\ No newline at end of file
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(exit_event.wait(), timeout=settings.WARM_BACKOFF)
+
+
+def meow_say(message: str, is_cowthink: bool = False, wrap_text: bool = True) -> str:
+    key = (message, is_cowthink, choice(["kitty", "hellokitty", "meow"]), wrap_text)
+
+    return settings.say_cache.get(key) or settings.say_cache.cache(
+        key,
+        "```\n{}\n{}\n```".format(
+            make_bubble(
+                message,
+                brackets=THOUGHT_OPTIONS["cowthink" if is_cowthink else "cowsay"],
+                wrap_text=wrap_text,
+            ),
+            meow_say_template(key[2], is_cowthink),
+        ),
+    )
+
+
+@cache
+def meow_say_template(cow: str, is_cowthink: bool) -> str:
+    return (
+        get_cow(cow)
+        .replace("$eyes", Option.eyes)
+        .replace(
+            "$thoughts", THOUGHT_OPTIONS["cowthink" if is_cowthink else "cowsay"].stem
+        )
+        .replace("$tongue", Option.tongue)
+    )
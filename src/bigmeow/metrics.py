@@ -0,0 +1,234 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from bisect import bisect_left
+from time import monotonic
+from typing import Any
+
+import structlog
+from dotenv import load_dotenv
+
+from bigmeow import settings
+
+load_dotenv()
+
+logger = structlog.get_logger()
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help), in the order they are rendered
+METRIC_DICT = {
+    "bigmeow_command_duration_seconds": (
+        "histogram",
+        "Time taken by a supervised task, per frontend and command",
+    ),
+    "bigmeow_upstream_duration_seconds": (
+        "histogram",
+        "Time until an upstream service responds, per host",
+    ),
+    "bigmeow_send_duration_seconds": (
+        "histogram",
+        "Time a reply waits in the send scheduler until it is delivered",
+    ),
+    "bigmeow_loop_lag_seconds": (
+        "histogram",
+        "How late the event loop wakes up a sleeping task, per loop",
+    ),
+    "bigmeow_cache_requests_total": ("counter", "Cache lookups, per cache and result"),
+    "bigmeow_photo_bytes_total": (
+        "counter",
+        "Bytes of new cat photos, as downloaded and as normalized for the cache",
+    ),
+    "bigmeow_discord_events_total": (
+        "counter",
+        "Gateway events handled, per Discord shard and event",
+    ),
+    "bigmeow_queue_depth": ("gauge", "Items waiting in a cross process queue"),
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Metrics:
+    def __init__(self, slots: int, size: int) -> None:
+        # every process publishes its own numbers into a slot of its own, the
+        # web worker answering /metrics adds all of them up
+        self.slot_list: list[settings.Shared_Value[dict[str, Any]]] = [
+            settings.Shared_Value({}, size) for _ in range(slots)
+        ]
+        self.slot_next = multiprocessing.Value("i", 0)
+        self.slot, self.pid, self.is_warned = None, os.getpid(), False
+
+        self.lock = threading.Lock()
+        self.counter_dict: dict[tuple[str, Labels], float] = {}
+        self.histogram_dict: dict[tuple[str, Labels], list[float]] = {}
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.counter_dict[key] = self.counter_dict.get(key, 0) + value
+
+    async def monitor(self, name: str, exit_event: Any) -> None:
+        published = monotonic()
+
+        while not exit_event.is_set():
+            started = monotonic()
+            await asyncio.sleep(settings.METRICS_LAG_INTERVAL)
+
+            self.observe(
+                "bigmeow_loop_lag_seconds",
+                monotonic() - started - settings.METRICS_LAG_INTERVAL,
+                loop=name,
+            )
+
+            if monotonic() - published > settings.METRICS_INTERVAL:
+                self.publish()
+                published = monotonic()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            if (histogram := self.histogram_dict.get(key)) is None:
+                # one count per bucket plus +Inf, then the sum
+                histogram = self.histogram_dict[key] = [0.0] * (len(BUCKETS) + 2)
+
+            histogram[bisect_left(BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def publish(self) -> None:
+        if self.pid != os.getpid():
+            # a forked child must not overwrite the slot of its parent
+            self.pid, self.slot, self.is_warned = os.getpid(), None, False
+
+        if self.slot is None:
+            with self.slot_next.get_lock():
+                self.slot = self.slot_next.value
+                self.slot_next.value += 1
+
+        if self.slot >= len(self.slot_list):
+            if not self.is_warned:
+                logger.warning(
+                    "METRICS: No slot left, this process is not reported",
+                    slots=len(self.slot_list),
+                )
+                self.is_warned = True
+
+            return
+
+        with self.lock:
+            counter_dict = dict(self.counter_dict)
+            histogram_dict = {
+                key: list(value) for key, value in self.histogram_dict.items()
+            }
+
+        for cache, stats in cache_stats().items():
+            for result, field in (("hit", "hits"), ("miss", "misses")):
+                counter_dict[
+                    (
+                        "bigmeow_cache_requests_total",
+                        (("cache", cache), ("result", result)),
+                    )
+                ] = stats[field]
+
+        self.slot_list[self.slot].store(
+            {"counter": counter_dict, "histogram": histogram_dict}
+        )
+
+    def render(self) -> str:
+        self.publish()
+
+        value_dict: dict[tuple[str, Labels], float] = {}
+        histogram_dict: dict[tuple[str, Labels], list[float]] = {}
+
+        for slot in self.slot_list[: self.slot_next.value]:
+            snapshot = slot.load()
+
+            for key, value in snapshot.get("counter", {}).items():
+                value_dict[key] = value_dict.get(key, 0) + value
+
+            for key, value in snapshot.get("histogram", {}).items():
+                histogram_dict[key] = [
+                    a + b
+                    for a, b in zip(histogram_dict.get(key, [0.0] * len(value)), value)
+                ]
+
+        for queue in ("telegram_updates", "telegram_messages", "discord_messages"):
+            value_dict[("bigmeow_queue_depth", (("queue", queue),))] = getattr(
+                settings, queue
+            ).qsize()
+
+        line_list = []
+        for name, (kind, help) in METRIC_DICT.items():
+            line_list += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+
+            for (key, labels), value in sorted(value_dict.items()):
+                if key == name:
+                    line_list.append(
+                        f"{name}{labels_format(labels)} {value_format(value)}"
+                    )
+
+            for (key, labels), histogram in sorted(histogram_dict.items()):
+                if key == name:
+                    line_list += histogram_format(name, labels, histogram)
+
+        return "\n".join(line_list) + "\n"
+
+
+def cache_stats() -> dict[str, dict[str, int | float]]:
+    return {
+        "blocked": settings.blocked_cache.stats(),
+        "cat": settings.cat_cache.stats(),
+        "cat_pool": settings.cat_pool.stats(),
+        "fact": settings.fact_cache.stats(),
+        "photo_handle": settings.photo_handle_cache.stats(),
+        "say": settings.say_cache.stats(),
+    }
+
+
+def histogram_format(name: str, labels: Labels, histogram: list[float]) -> list[str]:
+    line_list, total = [], 0.0
+
+    for bucket, value in zip((*BUCKETS, "+Inf"), histogram):
+        total += value
+        line_list.append(
+            f"{name}_bucket{labels_format((*labels, ('le', str(bucket))))}"
+            f" {value_format(total)}"
+        )
+
+    return line_list + [
+        f"{name}_sum{labels_format(labels)} {value_format(histogram[-1])}",
+        f"{name}_count{labels_format(labels)} {value_format(total)}",
+    ]
+
+
+def labels_format(labels: Labels) -> str:
+    return (
+        "{{{}}}".format(
+            ",".join(
+                '{}="{}"'.format(key, value.replace("\\", "\\\\").replace('"', '\\"'))
+                for key, value in labels
+            )
+        )
+        if labels
+        else ""
+    )
+
+
+def slots_count() -> int:
+    # a slot per process that publishes, the bot, every web worker and shard
+    # process, a debug run has fewer web workers, so this is never too few
+    return max(
+        settings.METRICS_SLOTS,
+        1 + int(os.environ.get("WEB_WORKERS", "4")) + settings.DISCORD_PROCESSES,
+    )
+
+
+def value_format(value: float) -> str:
+    # exact, counters and sums pass a million soon enough, :g would round them
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+metrics = Metrics(slots_count(), settings.METRICS_SLOT_SIZE)
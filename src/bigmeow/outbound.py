@@ -0,0 +1,226 @@
+import asyncio
+import contextlib
+from collections import OrderedDict, deque
+from datetime import timedelta
+from enum import IntEnum
+from time import monotonic
+from typing import Any, Awaitable, Callable, Hashable
+
+import structlog
+from dotenv import load_dotenv
+
+from bigmeow import settings
+from bigmeow.metrics import metrics
+
+load_dotenv()
+
+logger = structlog.get_logger()
+
+
+class Lane(IntEnum):
+    INTERACTIVE = 0
+    PUSH = 1
+
+
+class Token_Bucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate, self.burst = rate, burst
+        self.tokens, self.updated = burst, monotonic()
+
+    def delay(self) -> float:
+        now = monotonic()
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self.delay()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class Send_Job:
+    def __init__(
+        self,
+        chat_id: Hashable,
+        func: Callable[[], Awaitable[Any]],
+        future: asyncio.Future,
+        key: Hashable | None,
+    ) -> None:
+        self.chat_id, self.func, self.future, self.key = chat_id, func, future, key
+        self.enqueued = monotonic()
+
+
+class Send_Scheduler:
+    def __init__(
+        self,
+        name: str,
+        global_bucket: Token_Bucket,
+        chat_bucket: Callable[[Hashable], Token_Bucket],
+        retry_after: Callable[[Exception], float | None],
+    ) -> None:
+        self.name, self.global_bucket = name, global_bucket
+        self.chat_bucket, self.retry_after = chat_bucket, retry_after
+
+        self.bucket_dict: dict[Hashable, Token_Bucket] = {}
+        self.key_dict: dict[Hashable, Send_Job] = {}
+        self.lane_list: list[OrderedDict[Hashable, deque[Send_Job]]] = [
+            OrderedDict() for _ in Lane
+        ]
+        self.task_set: set[asyncio.Task] = set()
+        self.wakeup = asyncio.Event()
+
+        self.sent, self.coalesced, self.limited = 0, 0, 0
+        self.latency_list: deque[float] = deque(maxlen=settings.SEND_LATENCY_SAMPLES)
+
+    def depth(self, lane: Lane) -> int:
+        return sum(len(job_list) for job_list in self.lane_list[lane].values())
+
+    async def run(
+        self, exit_event: asyncio.Event | settings.Event | settings.PEvent
+    ) -> None:
+        logger.info("OUTBOUND: Starting send scheduler", name=self.name)
+
+        while not exit_event.is_set():
+            delay = self._dispatch()
+
+            self.wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+
+        logger.info("OUTBOUND: Stopping send scheduler", name=self.name, **self.stats())
+
+    def stats(self) -> dict[str, int | float]:
+        latency_list = sorted(self.latency_list) or [0.0]
+
+        return {
+            "interactive_depth": self.depth(Lane.INTERACTIVE),
+            "push_depth": self.depth(Lane.PUSH),
+            "in_flight": len(self.task_set),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "rate_limited": self.limited,
+            "latency_p50": latency_list[len(latency_list) // 2],
+            "latency_p99": latency_list[int(len(latency_list) * 0.99)],
+        }
+
+    def submit(
+        self,
+        chat_id: Hashable,
+        func: Callable[[], Awaitable[Any]],
+        lane: Lane = Lane.INTERACTIVE,
+        key: Hashable | None = None,
+    ) -> asyncio.Future:
+        # a send identical to one still waiting in the queue rides along with it
+        if key is not None and (job := self.key_dict.get(key)) is not None:
+            self.coalesced += 1
+            return job.future
+
+        job = Send_Job(chat_id, func, asyncio.get_running_loop().create_future(), key)
+
+        if key is not None:
+            self.key_dict[key] = job
+
+        self.lane_list[lane].setdefault(chat_id, deque()).append(job)
+        self.wakeup.set()
+
+        return job.future
+
+    def _bucket(self, chat_id: Hashable) -> Token_Bucket:
+        if (bucket := self.bucket_dict.get(chat_id)) is None:
+            if len(self.bucket_dict) > settings.SEND_BUCKET_LIMIT:
+                # a bucket that has refilled completely carries no state
+                self.bucket_dict = {
+                    key: value
+                    for key, value in self.bucket_dict.items()
+                    if value.delay() > 0 or value.tokens < value.burst
+                }
+
+            bucket = self.bucket_dict[chat_id] = self.chat_bucket(chat_id)
+
+        return bucket
+
+    def _dispatch(self) -> float | None:
+        # returns how long to sleep before the next job may go out, or None
+        # to sleep until something is submitted
+        delay = None
+
+        for lane in Lane:
+            chat_dict = self.lane_list[lane]
+
+            for chat_id in list(chat_dict):
+                if (wait := self.global_bucket.delay()) > 0:
+                    return wait
+
+                if (wait := self._bucket(chat_id).delay()) > 0:
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+
+                job_list = chat_dict.pop(chat_id)
+                job = job_list.popleft()
+
+                # round robin, a chat with more waiting goes to the back
+                if job_list:
+                    chat_dict[chat_id] = job_list
+
+                self.global_bucket.take()
+                self._bucket(chat_id).take()
+                self._send(lane, job)
+
+        return delay
+
+    def _requeue(self, lane: Lane, job: Send_Job) -> None:
+        chat_dict = self.lane_list[lane]
+        chat_dict[job.chat_id] = deque([job, *chat_dict.pop(job.chat_id, ())])
+        chat_dict.move_to_end(job.chat_id, last=False)
+
+        self.wakeup.set()
+
+    def _send(self, lane: Lane, job: Send_Job) -> None:
+        if job.key is not None:
+            self.key_dict.pop(job.key, None)
+
+        task = asyncio.create_task(job.func())
+        self.task_set.add(task)
+        task.add_done_callback(lambda task: self._sent(lane, job, task))
+
+    def _sent(self, lane: Lane, job: Send_Job, task: asyncio.Task) -> None:
+        self.task_set.discard(task)
+
+        if task.cancelled():
+            job.future.cancel()
+            return
+
+        if (exception := task.exception()) is None:
+            self.sent += 1
+            self.latency_list.append(latency := monotonic() - job.enqueued)
+            metrics.observe(
+                "bigmeow_send_duration_seconds", latency, frontend=self.name
+            )
+            job.future.set_result(task.result())
+
+        elif (seconds := self.retry_after(exception)) is not None:
+            self.limited += 1
+            logger.warning(
+                "OUTBOUND: Rate limited, retrying later",
+                name=self.name,
+                chat_id=job.chat_id,
+                retry_after=seconds,
+            )
+            self._bucket(job.chat_id).pause(seconds)
+            self._requeue(lane, job)
+
+        else:
+            logger.error("OUTBOUND: Unable to send", name=self.name, exc_info=exception)
+            job.future.set_exception(exception)
+
+            # nobody is required to await the result of a send
+            job.future.exception()
+
+
+def retry_seconds(value: float | timedelta) -> float:
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
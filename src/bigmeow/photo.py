@@ -0,0 +1,45 @@
+from io import BytesIO
+
+# runs in the photo workers only, see meow.meow_photo_normalize, so neither
+# Pillow nor the decoded image ever touches an event loop
+
+DIMENSION_MIN = 320
+QUALITY_LIST = (85, 75, 65, 50)
+
+
+def photo_encode(image, quality: int) -> bytes:
+    output = BytesIO()
+    image.save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+
+    return output.getvalue()
+
+
+def photo_normalize(payload: bytes, budget: int, dimension: int) -> bytes:
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(BytesIO(payload)) as image:
+            # an animation would lose every frame but the first one
+            if getattr(image, "is_animated", False):
+                return payload
+
+            image = ImageOps.exif_transpose(image).convert("RGB")
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # not something Pillow can read, it is sent as it came
+        return payload
+
+    result = payload
+    while True:
+        image.thumbnail((dimension, dimension))
+
+        # the best quality that fits the budget
+        for quality in QUALITY_LIST:
+            if len(encoded := photo_encode(image, quality)) <= budget:
+                return encoded if len(encoded) < len(payload) else payload
+
+            if len(encoded) < len(result):
+                result = encoded
+
+        # still over budget at the lowest quality, a quarter smaller each round
+        if (dimension := max(image.size) * 3 // 4) < DIMENSION_MIN:
+            return result
@@ -1,14 +1,25 @@
 import asyncio
 import contextlib
+import fcntl
+import mmap
+import multiprocessing
+import os
+import pickle
 import queue
+import struct
+import termios
 import threading
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 from datetime import date
 from enum import Enum
 from functools import partial
 from io import BytesIO
 from os import environ
 from random import choice, randint, shuffle
-from typing import Any, NamedTuple
+from time import monotonic, sleep
+from typing import Any, Awaitable, Callable, Generic, NamedTuple, TypeVar
 
 import structlog
 from dotenv import load_dotenv
@@ -17,58 +28,138 @@ logger = structlog.get_logger()
 
 load_dotenv()
 
+T = TypeVar("T")
+
 
 # TODO use proper typing and abstrct to abstract class in py3.12
 class Cat_Cache:
-    cat_list: list[BytesIO] = []
+    def __init__(self, size: int) -> None:
+        self.store: Shared_Value[list[bytes]] = Shared_Value([], size)
+        self.hits, self.misses = 0, 0
 
     def cache(self, cat: BytesIO) -> BytesIO:
         logger.info("CAT_CACHE: Storing a new photo to cache")
+        self.misses += 1
 
-        if len(self.cat_list) > CACHE_LIMIT:
-            self.cat_list[randint(0, CACHE_LIMIT - 1)] = cat
-        else:
-            self.cat_list.append(cat)
-
-        shuffle(self.cat_list)
+        self.store.update(partial(cache_insert, item=cat.getvalue()))
 
         return cat
 
-    def get(self) -> BytesIO:
-        assert len(self.cat_list) > 0
+    def get(self) -> BytesIO | None:
+        # empty until the first photo arrives, when every upstream failed so far
+        if not (cat_list := self.store.load()):
+            logger.warning("CAT_CACHE: No photo to retrieve")
+            return None
 
         logger.info("CAT_CACHE: Retrieve a photo")
-        return choice(self.cat_list)
+        self.hits += 1
+
+        return BytesIO(choice(cat_list))
+
+    def stats(self) -> dict[str, int | float]:
+        # a hit is a reply served from here because the upstream failed
+        return hit_stats(self.hits, self.misses)
+
+
+class Cat_Pool:
+    def __init__(self, size: int, ttl: float) -> None:
+        self.size, self.ttl = size, ttl
+        self.hits, self.misses = 0, 0
+
+        self.photo_list: deque[tuple[float, BytesIO]] = deque()
+        self.drain_list: deque[float] = deque()
+        self.drained = Event()
+
+    def deficit(self) -> int:
+        while self.photo_list and self.photo_list[0][0] + self.ttl < monotonic():
+            logger.info("CAT_POOL: Discarding a stale photo")
+            self.photo_list.popleft()
+
+        return max(self.size - len(self.photo_list), 0)
+
+    def drain_rate(self, window: float = 60) -> float:
+        while self.drain_list and self.drain_list[0] + window < monotonic():
+            self.drain_list.popleft()
+
+        return len(self.drain_list) / window
+
+    def get(self) -> BytesIO | None:
+        photo = None
+
+        with contextlib.suppress(IndexError):
+            while photo is None:
+                fetched_at, photo = self.photo_list.popleft()
+
+                if fetched_at + self.ttl < monotonic():
+                    photo = None
+
+        if photo is None:
+            self.misses += 1
+            logger.info("CAT_POOL: Pool is empty", **self.stats())
+        else:
+            self.hits += 1
+            logger.info("CAT_POOL: Retrieve a photo", **self.stats())
+
+        self.drain_list.append(monotonic())
+        self.drained.set()
+
+        return photo
+
+    def put(self, photo: BytesIO) -> None:
+        logger.info("CAT_POOL: Storing a new photo to pool")
+        self.photo_list.append((monotonic(), photo))
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "available": len(self.photo_list),
+            **hit_stats(self.hits, self.misses),
+        }
 
 
 class Event(threading.Event):
-    async def wait(self, timeout: int | None = 5) -> bool:
-        while True:
-            task = asyncio.get_event_loop().run_in_executor(
-                None, partial(super().wait, timeout)
-            )
-            await task
+    def __init__(self) -> None:
+        super().__init__()
+
+        self._lock = threading.Lock()
+        self._reader, self._writer = os.pipe()
+        os.set_blocking(self._reader, False)
+        os.set_blocking(self._writer, False)
 
-            if result := task.result():
-                return result
+    def set(self) -> None:
+        with self._lock:
+            super().set()
+            fd_notify(self._writer)
+
+    def clear(self) -> None:
+        with self._lock:
+            super().clear()
+            fd_drain(self._reader)
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        if not self.is_set():
+            await fd_wait(self._reader, timeout)
+
+        return self.is_set()
 
 
 class PEvent:
-    def __init__(self, event: threading.Event) -> None:
-        self.event = event
+    def __init__(self) -> None:
+        # the byte written by set() is never consumed, so the read end stays
+        # readable for every process holding a copy of it
+        self._reader, self._writer = multiprocessing.Pipe(duplex=False)
 
-    def set(self):
-        self.event.set()
+    def is_set(self) -> bool:
+        return self._reader.poll()
 
-    async def wait(self, timeout: int | None = 5) -> bool:
-        while True:
-            task = asyncio.get_event_loop().run_in_executor(
-                None, partial(self.event.wait, timeout)
-            )
-            await task
+    def set(self) -> None:
+        if not self.is_set():
+            fd_notify(self._writer.fileno())
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        if not self.is_set():
+            await fd_wait(self._reader.fileno(), timeout)
 
-            if result := task.result():
-                return result
+        return self.is_set()
 
 
 class Queue(queue.Queue):
@@ -106,6 +197,9 @@ class Lock(contextlib.AbstractAsyncContextManager):
         return self.release()
 
     async def acquire(self) -> bool:
+        if self.lock.acquire(False):
+            return True
+
         task = asyncio.get_event_loop().run_in_executor(None, self.lock.acquire)
         await task
 
@@ -119,52 +213,462 @@ class Lock(contextlib.AbstractAsyncContextManager):
 
 
 class PQueue:
-    def __init__(self, queue) -> None:
-        self.queue = queue
+    def __init__(self, maxsize: int | None = None) -> None:
+        self.maxsize = min(maxsize or QUEUE_LIMIT, PIPE_CAPACITY)
+
+        self._reader, self._writer = multiprocessing.Pipe(duplex=False)
+        self._rlock, self._wlock = multiprocessing.Lock(), multiprocessing.Lock()
+        self._pending: deque[Any] = deque()
+        self._feed_dict: dict[
+            asyncio.AbstractEventLoop, tuple[list[Any], asyncio.Future]
+        ] = {}
+
+        # one byte per free slot, producers take them before sending and
+        # consumers hand them back once an item leaves the queue
+        self._credit_reader, self._credit_writer = os.pipe()
+        os.set_blocking(self._credit_reader, False)
+        os.set_blocking(self._credit_writer, False)
+        os.write(self._credit_writer, b"\0" * self.maxsize)
+
+    def qsize(self) -> int:
+        credits = array("i", [0])
+        fcntl.ioctl(self._credit_reader, termios.FIONREAD, credits)
+
+        return self.maxsize - credits[0]
+
+    async def put(self, item: Any) -> None:
+        await self.put_many([item])
+
+    async def put_many(self, items: list[Any]) -> None:
+        while items:
+            count = await self._credits_take(len(items))
+            batch, items = items[:count], items[count:]
+
+            # credits bound the items, not the bytes, a large batch fills the
+            # pipe and blocks until a consumer drains it, so not on the loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._send, pickle.dumps(batch)
+            )
 
-    async def put(
-        self, item: dict[Any, Any], block: bool = True, timeout: int | None = None
-    ) -> None:
-        task = asyncio.get_event_loop().run_in_executor(
-            None, partial(self.queue.put, item, block, timeout)
-        )
-        await task
+    async def feed(self, item: Any) -> None:
+        loop = asyncio.get_running_loop()
 
-        return task.result()
+        # items fed during the same loop iteration are sent as one batch
+        if loop not in self._feed_dict:
+            self._feed_dict[loop] = ([], loop.create_future())
+            loop.call_soon(self._feed_flush, loop)
 
-    async def get(self, block: bool = True, timeout: int | None = 5) -> dict[Any, Any]:
+        item_list, done = self._feed_dict[loop]
+        item_list.append(item)
+
+        await asyncio.shield(done)
+
+    async def get(self) -> Any:
+        return (await self.get_many(1))[0]
+
+    async def get_many(self, limit: int | None = None) -> list[Any]:
+        limit = limit or self.maxsize
+
+        while not self._pending:
+            await fd_wait(self._reader.fileno())
+
+            # another consumer may be halfway through a large frame, waiting
+            # for it here would stall this loop, so try again in a moment
+            if not self._rlock.acquire(block=False):
+                await asyncio.sleep(QUEUE_RETRY_INTERVAL)
+                continue
+
+            # other consumers may have emptied the pipe since it turned readable
+            try:
+                while len(self._pending) < limit and self._reader.poll():
+                    self._pending.extend(pickle.loads(self._reader.recv_bytes()))
+            finally:
+                self._rlock.release()
+
+        result = [
+            self._pending.popleft() for _ in range(min(limit, len(self._pending)))
+        ]
+        os.write(self._credit_writer, b"\0" * len(result))
+
+        return result
+
+    def _feed_flush(self, loop: asyncio.AbstractEventLoop) -> None:
+        item_list, done = self._feed_dict.pop(loop)
+
+        def done_set(task: asyncio.Task) -> None:
+            if task.cancelled():
+                done.cancel()
+            elif task.exception() is not None:
+                done.set_exception(task.exception())  # type: ignore
+            else:
+                done.set_result(None)
+
+        loop.create_task(self.put_many(item_list)).add_done_callback(done_set)
+
+    def _send(self, payload: bytes) -> None:
+        with self._wlock:
+            self._writer.send_bytes(payload)
+
+    async def _credits_take(self, count: int) -> int:
         while True:
-            task = asyncio.get_event_loop().run_in_executor(
-                None, partial(self.queue.get, block, timeout)
-            )
+            with contextlib.suppress(BlockingIOError):
+                return len(os.read(self._credit_reader, count))
 
-            with contextlib.suppress(queue.Empty):
-                await task
+            await fd_wait(self._credit_reader)
+
+
+def cache_insert(item_list: list[T], item: T) -> list[T]:
+    item_list = list(item_list)
+
+    if len(item_list) > CACHE_LIMIT:
+        item_list[randint(0, CACHE_LIMIT - 1)] = item
+    else:
+        item_list.append(item)
+
+    shuffle(item_list)
+
+    return item_list
+
+
+def fd_drain(fd: int) -> None:
+    with contextlib.suppress(BlockingIOError):
+        while os.read(fd, 4096):
+            pass
+
+
+def fd_notify(fd: int) -> None:
+    with contextlib.suppress(BlockingIOError):
+        os.write(fd, b"\0")
 
-            if task.done() and task.exception() is None:
-                return task.result()
+
+async def fd_wait(fd: int, timeout: float | None = None) -> bool:
+    loop = asyncio.get_running_loop()
+
+    # each waiter registers its own duplicate, as a loop only keeps one reader
+    # callback per file descriptor
+    waiter, fd = loop.create_future(), os.dup(fd)
+    loop.add_reader(fd, lambda: waiter.done() or waiter.set_result(True))
+
+    try:
+        return await asyncio.wait_for(waiter, timeout)
+
+    except asyncio.TimeoutError:
+        return False
+
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+
+def hit_stats(hits: int, misses: int) -> dict[str, int | float]:
+    return {"hits": hits, "misses": misses, "hit_ratio": hits / ((hits + misses) or 1)}
 
 
 class Fact_Cache:
-    fact_list: list[str] = []
+    def __init__(self, size: int) -> None:
+        self.store: Shared_Value[list[str]] = Shared_Value([], size)
+        self.hits, self.misses = 0, 0
 
     def cache(self, fact: str) -> str:
         logger.info("FACT_CACHE: Storing a new fact to cache")
+        self.misses += 1
 
-        if len(self.fact_list) > CACHE_LIMIT:
-            self.fact_list[randint(0, CACHE_LIMIT - 1)] = fact
-        else:
-            self.fact_list.append(fact)
-
-        shuffle(self.fact_list)
+        self.store.update(partial(cache_insert, item=fact))
 
         return fact
 
-    def get(self) -> str:
-        assert len(self.fact_list) > 0
+    def get(self) -> str | None:
+        if not (fact_list := self.store.load()):
+            logger.warning("FACT_CACHE: No fact to retrieve")
+            return None
 
         logger.info("FACT_CACHE: Retrieve a fact")
-        return choice(self.fact_list)
+        self.hits += 1
+
+        return choice(fact_list)
+
+    def stats(self) -> dict[str, int | float]:
+        return hit_stats(self.hits, self.misses)
+
+
+class Photo_Handle_Cache:
+    def __init__(self, size: int, limit: int, ttl: float) -> None:
+        # what a platform handed back for a photo it was sent before, keyed by
+        # photo digest and platform, shared so an upload by one process saves
+        # the upload in every other
+        self.limit, self.ttl = limit, ttl
+        self.store: Shared_Value[
+            dict[tuple[str, str], tuple[float, str, str | None]]
+        ] = Shared_Value({}, size)
+        self.hits, self.misses = 0, 0
+
+    def cache(
+        self, digest: str, platform: str, handle: str, source: str | None = None
+    ) -> str:
+        # source is whatever the handle stops working without, e.g. the message
+        # a photo was attached to
+        logger.info("PHOTO_HANDLE_CACHE: Storing a photo handle", platform=platform)
+
+        def insert(handle_dict: dict) -> dict:
+            handle_dict = {
+                key: value
+                for key, value in handle_dict.items()
+                if key != (digest, platform) and value[0] > monotonic()
+            } | {(digest, platform): (monotonic() + self.ttl, handle, source)}
+
+            # the oldest go first, a dict keeps the order things were added in
+            return dict(list(handle_dict.items())[-self.limit :])
+
+        self.store.update(insert)
+
+        return handle
+
+    def forget(self, digest: str, platform: str) -> None:
+        logger.info("PHOTO_HANDLE_CACHE: Forgetting a photo handle", platform=platform)
+
+        self.store.update(
+            lambda handle_dict: {
+                key: value
+                for key, value in handle_dict.items()
+                if key != (digest, platform)
+            }
+        )
+
+    def forget_source(self, platform: str, source_list: list[str]) -> None:
+        key_set = {
+            key
+            for key, (_expiry, _handle, source) in self.store.load().items()
+            if key[1] == platform and source in source_list
+        }
+
+        # most of what goes away never held a photo, those are not worth a write
+        if not key_set:
+            return
+
+        logger.info("PHOTO_HANDLE_CACHE: Forgetting a photo source", platform=platform)
+
+        self.store.update(
+            lambda handle_dict: {
+                key: value for key, value in handle_dict.items() if key not in key_set
+            }
+        )
+
+    def get(self, digest: str, platform: str) -> str | None:
+        expiry, handle, _source = self.store.load().get(
+            (digest, platform), (0, None, None)
+        )
+
+        if expiry < monotonic():
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return handle
+
+    def stats(self) -> dict[str, int | float]:
+        # a hit is a photo sent by reference, without uploading it again
+        return hit_stats(self.hits, self.misses)
+
+
+class Readiness:
+    def __init__(self, required: tuple[str, ...], size: int) -> None:
+        # startup steps mark themselves done in any order, from any process,
+        # the ones in required are all it takes to start serving
+        self.required = required
+        self.store: Shared_Value[dict[str, bool]] = Shared_Value({}, size)
+
+    def is_ready(self) -> bool:
+        step_dict = self.store.load()
+
+        return all(step_dict.get(step, False) for step in self.required)
+
+    def mark(self, step: str, is_done: bool = True) -> None:
+        logger.info("READINESS: Marking a startup step", step=step, is_done=is_done)
+
+        self.store.update(lambda step_dict: step_dict | {step: is_done})
+
+    def stats(self) -> dict[str, bool]:
+        return {step: False for step in self.required} | self.store.load()
+
+
+class Say_Cache:
+    def __init__(self, size: int, entry_limit: int) -> None:
+        self.size, self.entry_limit = size, entry_limit
+        self.hits, self.misses, self.used = 0, 0, 0
+
+        self.lock = threading.Lock()
+        self.say_dict: OrderedDict[tuple[str, bool, str, bool], str] = OrderedDict()
+
+    def cache(self, key: tuple[str, bool, str, bool], rendered: str) -> str:
+        # long renders are rarely repeated, keeping them would only push out
+        # the short fact and petrol replies that are
+        if len(rendered) > self.entry_limit:
+            return rendered
+
+        with self.lock:
+            if (previous := self.say_dict.pop(key, None)) is not None:
+                self.used -= len(previous)
+
+            self.say_dict[key] = rendered
+            self.used += len(rendered)
+
+            while self.used > self.size:
+                self.used -= len(self.say_dict.popitem(last=False)[1])
+
+        return rendered
+
+    def get(self, key: tuple[str, bool, str, bool]) -> str | None:
+        with self.lock:
+            if (rendered := self.say_dict.get(key)) is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.say_dict.move_to_end(key)
+
+        return rendered
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "entries": len(self.say_dict),
+            "used": self.used,
+            **hit_stats(self.hits, self.misses),
+        }
+
+
+class Shared_Value(Generic[T]):
+    # a sequence number followed by the payload length
+    FIELD = struct.Struct("Q")
+    HEADER_SIZE = FIELD.size * 2
+
+    def __init__(self, value: T, size: int) -> None:
+        self.size = size
+
+        # an anonymous shared mapping, every process forked after this sees
+        # the same pages, so one process's write warms all of them
+        self.buffer = mmap.mmap(-1, self.HEADER_SIZE + size)
+        self.lock = multiprocessing.Lock()
+        self.memo: tuple[int, T] = (-1, value)
+
+        with self.lock:
+            self._store(value)
+
+    def load(self) -> T:
+        # seqlock read, the writer keeps the sequence odd while it writes, so
+        # a snapshot only counts if the sequence is even and unchanged after
+        while True:
+            (sequence,) = self.FIELD.unpack_from(self.buffer)
+
+            if sequence == (memo := self.memo)[0]:
+                return memo[1]
+
+            if sequence % 2 == 0:
+                (length,) = self.FIELD.unpack_from(self.buffer, self.FIELD.size)
+                payload = self.buffer[self.HEADER_SIZE : self.HEADER_SIZE + length]
+
+                if self.FIELD.unpack_from(self.buffer) == (sequence,):
+                    self.memo = (sequence, pickle.loads(payload))
+
+                    return self.memo[1]
+
+            sleep(0)
+
+    def store(self, value: T) -> bool:
+        with self.lock:
+            return self._store(value)
+
+    def update(self, func: Callable[[T], T]) -> T:
+        with self.lock:
+            value = func(self.load())
+            self._store(value)
+
+        return value
+
+    def _store(self, value: T) -> bool:
+        if len(payload := pickle.dumps(value)) > self.size:
+            logger.warning(
+                "SHARED_VALUE: Value is too large, discarding",
+                size=len(payload),
+                limit=self.size,
+            )
+            return False
+
+        (sequence,) = self.FIELD.unpack_from(self.buffer)
+
+        self.FIELD.pack_into(self.buffer, 0, sequence + 1)
+        self.buffer[self.HEADER_SIZE : self.HEADER_SIZE + len(payload)] = payload
+        self.FIELD.pack_into(self.buffer, self.FIELD.size, len(payload))
+        self.FIELD.pack_into(self.buffer, 0, sequence + 2)
+
+        return True
+
+
+class Single_Flight:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flight_dict: dict[str, Future] = {}
+
+    async def run(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        with self.lock:
+            if is_leader := (future := self.flight_dict.get(key)) is None:
+                future = self.flight_dict[key] = Future()
+
+                # followers on other loops must not be able to cancel it
+                future.set_running_or_notify_cancel()
+
+        if not is_leader:
+            logger.info("SINGLE_FLIGHT: Joining an in-flight request", key=key)
+            return await asyncio.wrap_future(future)
+
+        try:
+            result = await func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                del self.flight_dict[key]
+
+        return result
+
+
+class TTL_Cache(Generic[T]):
+    def __init__(self, size: int, ttl: float) -> None:
+        self.size, self.ttl = size, ttl
+        self.hits, self.misses = 0, 0
+
+        self.lock = threading.Lock()
+        self.item_dict: OrderedDict[Any, tuple[float, T]] = OrderedDict()
+
+    def cache(self, key: Any, value: T) -> T:
+        with self.lock:
+            self.item_dict[key] = (monotonic() + self.ttl, value)
+            self.item_dict.move_to_end(key)
+
+            while len(self.item_dict) > self.size:
+                self.item_dict.popitem(last=False)
+
+        return value
+
+    def get(self, key: Any) -> T | None:
+        with self.lock:
+            expiry, value = self.item_dict.get(key, (0, None))
+
+            if expiry < monotonic():
+                self.item_dict.pop(key, None)
+                self.misses, value = self.misses + 1, None
+            else:
+                self.hits += 1
+
+        return value
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "entries": len(self.item_dict),
+            **hit_stats(self.hits, self.misses),
+        }
 
 
 class Row(NamedTuple):
@@ -187,6 +691,12 @@ class Latest(NamedTuple):
     change: Change
 
 
+class Latest_Source(NamedTuple):
+    etag: str | None
+    last_modified: str | None
+    fieldnames: tuple[str, ...]
+
+
 class MeowCommand(Enum):
     SAY = "meowsay"
     PETROL = "meowpetrol"
@@ -206,18 +716,98 @@ class MeowCommand(Enum):
         return f"{COMMAND_PREFIX}{self.value}"
 
 
-cat_cache, cat_lock = Cat_Cache(), asyncio.Lock()
-fact_cache, fact_lock = Fact_Cache(), asyncio.Lock()
-latest_cache, latest_lock = (
-    Latest(Level(date.min, 0, 0, 0), Change(date.min, 0, 0, 0)),
-    asyncio.Lock(),
-)
-
+BLOCKED_CACHE_SIZE = int(environ.get("BLOCKED_CACHE_SIZE", "256"))
+BLOCKED_CACHE_TTL = float(environ.get("BLOCKED_CACHE_TTL", "300"))
+BOT_RUNTIME = environ.get("BOT_RUNTIME", "threads")
 CACHE_LIMIT = 5
+CAT_CACHE_SIZE = int(environ.get("CAT_CACHE_SIZE", str(8 * 1024 * 1024)))
+CAT_POOL_BACKOFF = 30
+CAT_POOL_CONCURRENCY = int(environ.get("CAT_POOL_CONCURRENCY", "4"))
+CAT_POOL_SIZE = int(environ.get("CAT_POOL_SIZE", "3"))
+CAT_POOL_TTL = float(environ.get("CAT_POOL_TTL", "3600"))
+CHANNEL_CACHE_SIZE = int(environ.get("CHANNEL_CACHE_SIZE", "256"))
+CHANNEL_CACHE_TTL = float(environ.get("CHANNEL_CACHE_TTL", "3600"))
+METRICS_INTERVAL = float(environ.get("METRICS_INTERVAL", "5"))
+METRICS_LAG_INTERVAL = 0.5
+METRICS_SLOTS = 16
+METRICS_SLOT_SIZE = 256 * 1024
+PHOTO_BUDGET = int(environ.get("PHOTO_BUDGET", str(128 * 1024)))
+PHOTO_DIMENSION = 1280
+PHOTO_HANDLE_LIMIT = 256
+PHOTO_HANDLE_SIZE = 128 * 1024
+PHOTO_HANDLE_TTL = float(environ.get("PHOTO_HANDLE_TTL", "43200"))
+PHOTO_WORKERS = int(environ.get("PHOTO_WORKERS", "1"))
+PIPE_CAPACITY = 65536
+LATEST_CACHE_SIZE = 4096
+PETROL_TAIL_SIZE = 4096
+SEND_BUCKET_LIMIT = 4096
+SEND_LATENCY_SAMPLES = 1024
+SAY_CACHE_ENTRY_LIMIT = 4096
+SAY_CACHE_SIZE = int(environ.get("SAY_CACHE_SIZE", str(1024 * 1024)))
+QUEUE_LIMIT = int(environ.get("QUEUE_LIMIT", "1024"))
+QUEUE_RETRY_INTERVAL = 0.001
+READINESS_REQUIRED = ("cat", "fact")
+READINESS_SIZE = 4096
 DATE_FORMAT = "%d/%m/%Y"
-WEB_TELEGRAM_TOKEN = environ["WEB_TELEGRAM_TOKEN"]
+DISCORD_CHANNEL_BURST = 5
+DISCORD_CHANNEL_RATE = 1.0
+DISCORD_GLOBAL_RATE = float(environ.get("DISCORD_GLOBAL_RATE", "50"))
+DISCORD_IDENTIFY_INTERVAL = float(environ.get("DISCORD_IDENTIFY_INTERVAL", "5"))
+DISCORD_IDENTIFY_SIZE = 64
+DISCORD_PROCESSES = int(environ.get("DISCORD_PROCESSES", "0"))
+DISCORD_SHARD_COUNT = int(environ.get("DISCORD_SHARD_COUNT", "1"))
+EVENT_LOOP = environ.get("EVENT_LOOP", "asyncio")
+FACT_CACHE_SIZE = 64 * 1024
+HTTP_DNS_TTL = int(environ.get("HTTP_DNS_TTL", "300"))
+HTTP_LIMIT = int(environ.get("HTTP_LIMIT", "100"))
+HTTP_LIMIT_PER_HOST = int(environ.get("HTTP_LIMIT_PER_HOST", "10"))
+TASK_COMMAND_LIMIT = {"messages_consume": 1, "meow": 8}
+TASK_DURATION_SAMPLES = 1024
+TASK_LIMIT = int(environ.get("TASK_LIMIT", "32"))
+TASK_QUEUE_LIMIT = int(environ.get("TASK_QUEUE_LIMIT", "64"))
+TELEGRAM_CHAT_RATE = 1.0
+TELEGRAM_GLOBAL_RATE = float(environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_GROUP_RATE = 20 / 60
+TELEGRAM_INGEST = environ.get("TELEGRAM_INGEST", "webhook")
+TELEGRAM_POLL_BACKOFF = 5
+TELEGRAM_POLL_LIMIT = int(environ.get("TELEGRAM_POLL_LIMIT", "100"))
+TELEGRAM_POLL_TIMEOUT = int(environ.get("TELEGRAM_POLL_TIMEOUT", "30"))
+URL_BLOCKEDORNOT = environ.get(
+    "URL_BLOCKEDORNOT", "https://blockedornot.sinarproject.org/api/"
+)
+URL_CATAAS = environ.get("URL_CATAAS", "https://cataas.com/cat/says/meow?type=square")
+URL_DISCORD_API = environ.get("URL_DISCORD_API", "https://discord.com/api/v10")
+URL_DISCORD_GATEWAY = environ.get("URL_DISCORD_GATEWAY", "wss://gateway.discord.gg/")
+URL_FACT = environ.get("URL_FACT", "https://meowfacts.herokuapp.com/")
+URL_IFTTT = environ.get(
+    "URL_IFTTT", "https://maker.ifttt.com/trigger/prompt/with/key/{key}"
+)
+URL_PETROL = environ.get(
+    "URL_PETROL", "https://storage.data.gov.my/commodities/fuelprice.csv"
+)
+URL_TELEGRAM = environ.get("URL_TELEGRAM", "https://api.telegram.org/bot")
+WARM_BACKOFF = float(environ.get("WARM_BACKOFF", "5"))
+
+blocked_cache: TTL_Cache[str] = TTL_Cache(BLOCKED_CACHE_SIZE, BLOCKED_CACHE_TTL)
+blocked_flight = Single_Flight()
+cat_cache = Cat_Cache(CAT_CACHE_SIZE)
+cat_pool = Cat_Pool(CAT_POOL_SIZE, CAT_POOL_TTL)
+discord_identify: Shared_Value[float] = Shared_Value(0.0, DISCORD_IDENTIFY_SIZE)
+fact_cache = Fact_Cache(FACT_CACHE_SIZE)
+latest_cache: Shared_Value[Latest] = Shared_Value(
+    Latest(Level(date.min, 0, 0, 0), Change(date.min, 0, 0, 0)), LATEST_CACHE_SIZE
+)
+latest_lock: asyncio.Lock | Lock = asyncio.Lock()
+latest_source: Shared_Value[Latest_Source] = Shared_Value(
+    Latest_Source(None, None, ()), LATEST_CACHE_SIZE
+)
+photo_handle_cache = Photo_Handle_Cache(
+    PHOTO_HANDLE_SIZE, PHOTO_HANDLE_LIMIT, PHOTO_HANDLE_TTL
+)
+readiness = Readiness(READINESS_REQUIRED, READINESS_SIZE)
+say_cache = Say_Cache(SAY_CACHE_SIZE, SAY_CACHE_ENTRY_LIMIT)
 
-telegram_updates = asyncio.Queue()
+telegram_updates = PQueue()
 
-telegram_messages = asyncio.Queue()
-discord_messages = asyncio.Queue()
\ No newline at end of file
+telegram_messages = PQueue()
+discord_messages = PQueue()
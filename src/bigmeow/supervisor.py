@@ -0,0 +1,159 @@
+import asyncio
+from collections import deque
+from time import monotonic
+from typing import Coroutine
+
+import structlog
+from dotenv import load_dotenv
+
+from bigmeow import settings
+from bigmeow.metrics import metrics
+
+load_dotenv()
+
+logger = structlog.get_logger()
+
+
+class Command_State:
+    def __init__(self) -> None:
+        self.in_flight, self.done, self.failed, self.shed = 0, 0, 0, 0
+        self.waiting: deque[tuple[Coroutine, asyncio.Future]] = deque()
+        self.duration_list: deque[float] = deque(maxlen=settings.TASK_DURATION_SAMPLES)
+
+    def stats(self) -> dict[str, int | float]:
+        duration_list = sorted(self.duration_list) or [0.0]
+
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self.waiting),
+            "done": self.done,
+            "failed": self.failed,
+            "shed": self.shed,
+            "duration_p50": duration_list[len(duration_list) // 2],
+            "duration_p99": duration_list[int(len(duration_list) * 0.99)],
+        }
+
+
+class Task_Supervisor:
+    def __init__(
+        self,
+        name: str,
+        limit_dict: dict[str, int] | None = None,
+        limit: int = settings.TASK_LIMIT,
+        queue_limit: int = settings.TASK_QUEUE_LIMIT,
+    ) -> None:
+        self.name, self.limit, self.queue_limit = name, limit, queue_limit
+        self.limit_dict = settings.TASK_COMMAND_LIMIT | (limit_dict or {})
+
+        self.state_dict: dict[str, Command_State] = {}
+        self.task_set: set[asyncio.Task] = set()
+
+    async def close(self) -> None:
+        for state in self.state_dict.values():
+            while state.waiting:
+                coro, future = state.waiting.popleft()
+                coro.close()
+                future.cancel()
+
+        for task in self.task_set:
+            task.cancel()
+
+        await asyncio.gather(*self.task_set, return_exceptions=True)
+
+        logger.info("SUPERVISOR: Stopped", name=self.name, stats=self.stats())
+
+    def spawn(self, command: str, coro: Coroutine) -> asyncio.Future | None:
+        # returns None when the command is saturated and its queue is full, the
+        # caller decides whether that is worth telling anyone about
+        state = self.state_dict.setdefault(command, Command_State())
+        future = asyncio.get_running_loop().create_future()
+
+        if state.in_flight < self.limit_dict.get(command, self.limit):
+            self._start(command, state, coro, future)
+
+        elif len(state.waiting) < self.queue_limit:
+            state.waiting.append((coro, future))
+
+        else:
+            state.shed += 1
+            coro.close()
+
+            logger.warning("SUPERVISOR: Shedding task", name=self.name, command=command)
+            return None
+
+        return future
+
+    def stats(self) -> dict[str, dict[str, int | float]]:
+        return {command: state.stats() for command, state in self.state_dict.items()}
+
+    def _start(
+        self,
+        command: str,
+        state: Command_State,
+        coro: Coroutine,
+        future: asyncio.Future,
+    ) -> None:
+        started = monotonic()
+        state.in_flight += 1
+
+        task = asyncio.create_task(coro)
+        self.task_set.add(task)
+        task.add_done_callback(
+            lambda task: self._done(command, state, future, started, task)
+        )
+
+        # giving up on the result gives up on the task as well
+        future.add_done_callback(lambda future: future.cancelled() and task.cancel())
+
+    def _done(
+        self,
+        command: str,
+        state: Command_State,
+        future: asyncio.Future,
+        started: float,
+        task: asyncio.Task,
+    ) -> None:
+        self.task_set.discard(task)
+        state.in_flight -= 1
+        state.duration_list.append(duration := monotonic() - started)
+        metrics.observe(
+            "bigmeow_command_duration_seconds",
+            duration,
+            frontend=self.name,
+            command=command,
+        )
+
+        if task.cancelled():
+            future.cancel()
+
+        elif (exception := task.exception()) is None:
+            state.done += 1
+
+            if not future.done():
+                future.set_result(task.result())
+
+        else:
+            state.failed += 1
+            logger.error(
+                "SUPERVISOR: Task failed",
+                name=self.name,
+                command=command,
+                exc_info=exception,
+            )
+
+            if not future.done():
+                future.set_exception(exception)
+
+                # nobody is required to await a supervised task
+                future.exception()
+
+        # a finished task hands its slot to the oldest one waiting
+        while state.waiting:
+            coro, waiting_future = state.waiting.popleft()
+
+            if waiting_future.cancelled():
+                coro.close()
+                continue
+
+            self._start(command, state, coro, waiting_future)
+            break
@@ -1,71 +1,101 @@
 import asyncio
 import json
 import os
+from functools import partial
+from io import BytesIO
 
 import structlog
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Bot, Message, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
-    CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
 )
 
 import bigmeow.settings as settings
-from bigmeow.common import check_is_debug, message_contains
+from bigmeow.common import Command_Router, check_is_debug, session_close
 from bigmeow.meow import (
+    PHOTO_MISSING,
     meow_blockedornot,
     meow_fact,
     meow_fetch_photo,
     meow_petrol,
+    meow_photo_digest,
     meow_prompt,
     meow_say,
 )
+from bigmeow.metrics import metrics
+from bigmeow.outbound import Lane, Send_Scheduler, Token_Bucket, retry_seconds
 from bigmeow.settings import MeowCommand
+from bigmeow.supervisor import Task_Supervisor
 
 load_dotenv()
 
 logger = structlog.get_logger()
-application = ApplicationBuilder().token(os.environ["TELEGRAM_TOKEN"]).build()
+
+# built by run, so importing this module does not set up a bot
+application: Application
+
+
+def application_init() -> Application:
+    return (
+        ApplicationBuilder()
+        .token(os.environ["TELEGRAM_TOKEN"])
+        .base_url(settings.URL_TELEGRAM)
+        .build()
+    )
 
 
 async def blockedornot_fetch(
-    update: Update, context: ContextTypes.DEFAULT_TYPE
+    update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str
 ) -> None:
     logger.info("TELEGRAM: Processing isblocked request", update=update)
 
     if update.message and update.message.text and update.effective_chat:
-        asyncio.create_task(
-            context.bot.send_message(
+        scheduler.submit(
+            update.effective_chat.id,
+            partial(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 parse_mode=ParseMode.MARKDOWN,
-                text=await meow_blockedornot(
-                    update.message.text.replace(MeowCommand.ISBLOCKED.telegram(), "")
-                    .replace(str(MeowCommand.ISBLOCKED), "")
-                    .strip(),
-                ),
+                text=await meow_blockedornot(argument),
                 reply_to_message_id=update.message.id,
                 allow_sending_without_reply=True,
-            )
+            ),
         )
 
 
-async def fact_fetch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def chat_bucket(chat_id: int | str) -> Token_Bucket:
+    # groups and channels have negative ids, and a much lower limit
+    return (
+        Token_Bucket(settings.TELEGRAM_GROUP_RATE, 3)
+        if int(chat_id) < 0
+        else Token_Bucket(settings.TELEGRAM_CHAT_RATE, 3)
+    )
+
+
+async def fact_fetch(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, _argument: str
+) -> None:
     logger.info("TELEGRAM: Processing fact request", update=update)
 
     if update.message and update.message.text and update.effective_chat:
-            asyncio.create_task(
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    parse_mode=ParseMode.MARKDOWN,
-                    text=await meow_fact(),
-                    reply_to_message_id=update.message.id,
-                    allow_sending_without_reply=True,
-                )
-            )
+        scheduler.submit(
+            update.effective_chat.id,
+            partial(
+                context.bot.send_message,
+                chat_id=update.effective_chat.id,
+                parse_mode=ParseMode.MARKDOWN,
+                text=await meow_fact(),
+                reply_to_message_id=update.message.id,
+                allow_sending_without_reply=True,
+            ),
+        )
 
 
 async def message_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -74,62 +104,56 @@ async def message_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     logger.info("TELEGRAM: Received an update", update=update)
 
-    if message_contains(update.message.text, str(MeowCommand.SAY)):
-        asyncio.create_task(say_create(update, context))
-
-    elif message_contains(update.message.text, str(MeowCommand.THINK)):
-        asyncio.create_task(think_create(update, context))
-
-    elif message_contains(update.message.text, str(MeowCommand.PROMPT)):
-        asyncio.create_task(prompt_create(update, context))
-
-    elif message_contains(update.message.text, str(MeowCommand.PETROL)):
-        asyncio.create_task(petrol_fetch(update, context))
+    if route := router.match(update.message.text):
+        handler, argument = route
 
-    elif message_contains(update.message.text, str(MeowCommand.FACT)):
-        asyncio.create_task(fact_fetch(update, context))
-
-    elif message_contains(update.message.text, str(MeowCommand.ISBLOCKED)):
-        asyncio.create_task(blockedornot_fetch(update, context))
-
-    elif message_contains(update.message.text, "meow", is_command=False):
-        logger.info("TELEGRAM: Sending a cat photo", update=update)
-        asyncio.create_task(
-            context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=await meow_fetch_photo(),
-                caption="photo from https://cataas.com/",
-                reply_to_message_id=update.message.id,
-                allow_sending_without_reply=True,
-            )
-        )
+        supervisor.spawn(router.name(handler), handler(update, context, argument))
 
 
 async def messages_consume() -> None:
     global application
 
     while message := await settings.telegram_messages.get():
-        asyncio.create_task(application.bot.send_message(**message))
+        scheduler.submit(
+            message["chat_id"],
+            partial(application.bot.send_message, **message),
+            lane=Lane.PUSH,
+            key=(message["chat_id"], message["reply_to_message_id"], message["text"]),
+        )
 
 
-async def petrol_fetch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def petrol_fetch(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, _argument: str
+) -> None:
     logger.info("TELEGRAM: Processing petrol request", update=update)
 
     if update.message and update.message.text and update.effective_chat:
-        asyncio.create_task(
-            context.bot.send_message(
+        scheduler.submit(
+            update.effective_chat.id,
+            partial(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 parse_mode=ParseMode.MARKDOWN,
                 text=await meow_petrol(),
                 reply_to_message_id=update.message.id,
                 allow_sending_without_reply=True,
-            )
+            ),
         )
 
 
+def retry_after(exception: Exception) -> float | None:
+    return (
+        retry_seconds(exception.retry_after)
+        if isinstance(exception, RetryAfter)
+        else None
+    )
+
+
 async def run(exit_event: asyncio.Event | settings.Event) -> None:
     global application
 
+    application = application_init()
+
     await setup()
 
     async with application:
@@ -137,27 +161,41 @@ async def run(exit_event: asyncio.Event | settings.Event) -> None:
         await application.start()
 
         logger.info("TELEGRAM: Ready for requests")
+        settings.readiness.mark("telegram")
 
         if not check_is_debug():
             logger.info(
                 "TELEGRAM: Sending up message to owner",
                 chat_id=os.environ["TELEGRAM_USER"],
             )
-            asyncio.create_task(
-                application.bot.send_message(
+            scheduler.submit(
+                os.environ["TELEGRAM_USER"],
+                partial(
+                    application.bot.send_message,
                     chat_id=os.environ["TELEGRAM_USER"],
                     parse_mode=ParseMode.MARKDOWN,
                     text=meow_say("Bot is up"),
-                )
+                ),
+                lane=Lane.PUSH,
             )
 
-        asyncio.create_task(updates_consume())
-        asyncio.create_task(messages_consume())
+        supervisor.spawn("scheduler", scheduler.run(exit_event))
+        supervisor.spawn("metrics", metrics.monitor("telegram", exit_event))
+
+        # updates either come through the web workers, or straight from here
+        if settings.TELEGRAM_INGEST == "polling":
+            supervisor.spawn("updates_poll", updates_poll())
+        else:
+            supervisor.spawn("updates_consume", updates_consume())
+
+        supervisor.spawn("messages_consume", messages_consume())
 
         await exit_event.wait()
 
         logger.info("TELEGRAM: Stopping")
         await application.stop()
+        await supervisor.close()
+        await session_close()
 
 
 async def setup() -> None:
@@ -165,81 +203,204 @@ async def setup() -> None:
 
     logger.info("TELEGRAM: Initializing application")
 
-    application.add_handlers(
-        [
-            CommandHandler(MeowCommand.PETROL.value, petrol_fetch),
-            CommandHandler(MeowCommand.SAY.value, say_create),
-            CommandHandler(MeowCommand.THINK.value, think_create),
-            CommandHandler(MeowCommand.PROMPT.value, prompt_create),
-            CommandHandler(MeowCommand.FACT.value, fact_fetch),
-            CommandHandler(MeowCommand.ISBLOCKED.value, blockedornot_fetch),
-            MessageHandler(filters.TEXT, message_filter),
-        ]
-    )
+    # commands are routed by message_filter as well, for both prefixes
+    application.add_handler(MessageHandler(filters.TEXT, message_filter))
+
+    match settings.TELEGRAM_INGEST:
+        case "webhook":
+            supervisor.spawn(
+                "set_webhook",
+                application.bot.set_webhook(
+                    f'{os.environ["WEBHOOK_URL"]}/telegram',
+                    allowed_updates=Update.ALL_TYPES,
+                    secret_token=os.environ["WEB_TELEGRAM_TOKEN"],
+                ),
+            )
+
+        case "polling":
+            # updates_poll removes the webhook itself, before its first poll
+            pass
+
+        case _:
+            raise ValueError(f"Invalid TELEGRAM_INGEST {settings.TELEGRAM_INGEST}")
 
-    asyncio.create_task(
-        application.bot.set_webhook(
-            f'{os.environ["WEBHOOK_URL"]}/telegram',
-            allowed_updates=Update.ALL_TYPES,
-            secret_token=settings.WEB_TELEGRAM_TOKEN,
+
+async def photo_send(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, _argument: str
+) -> None:
+    logger.info("TELEGRAM: Sending a cat photo", update=update)
+
+    if update.message and update.effective_chat:
+        if (photo := await meow_fetch_photo()) is None:
+            await say_create(update, context, PHOTO_MISSING)
+            return
+
+        scheduler.submit(
+            update.effective_chat.id,
+            partial(
+                photo_upload,
+                context.bot,
+                meow_photo_digest(photo),
+                photo,
+                chat_id=update.effective_chat.id,
+                caption="photo from https://cataas.com/",
+                reply_to_message_id=update.message.id,
+                allow_sending_without_reply=True,
+            ),
         )
-    )
 
 
-async def prompt_create(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def photo_upload(bot: Bot, digest: str, photo: BytesIO, **kwargs) -> Message:
+    # a photo uploaded before is sent by its file_id, without the bytes
+    if file_id := settings.photo_handle_cache.get(digest, "telegram"):
+        try:
+            return await bot.send_photo(photo=file_id, **kwargs)
+        except BadRequest as exception:
+            logger.warning(
+                "TELEGRAM: Photo file_id is refused, uploading it again",
+                exc_info=exception,
+            )
+            settings.photo_handle_cache.forget(digest, "telegram")
+
+    message = await bot.send_photo(photo=photo.getvalue(), **kwargs)
+
+    # the largest size is the one that was uploaded
+    if message.photo:
+        settings.photo_handle_cache.cache(digest, "telegram", message.photo[-1].file_id)
+
+    return message
+
+
+async def prompt_create(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str
+) -> None:
     logger.info("TELEGRAM: Dispatching prompt request", update=update)
 
     if update.message and update.message.text and update.effective_chat:
         await meow_prompt(
-            update.message.text.replace(MeowCommand.PROMPT.telegram(), "")
-            .replace(str(MeowCommand.PROMPT), "")
-            .strip(),
+            argument,
             channel="telegram",
             destination=json.dumps((update.effective_chat.id, update.message.id)),
         )
 
 
-async def say_create(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def say_create(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str
+) -> None:
     logger.info("TELEGRAM: Processing say request", update=update)
 
     if update.message and update.message.text and update.effective_chat:
-        asyncio.create_task(
-            context.bot.send_message(
+        scheduler.submit(
+            update.effective_chat.id,
+            partial(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 parse_mode=ParseMode.MARKDOWN,
-                text=meow_say(
-                    update.message.text.replace(MeowCommand.SAY.telegram(), "")
-                    .replace(str(MeowCommand.SAY), "")
-                    .strip()
-                ),
+                text=meow_say(argument),
                 reply_to_message_id=update.message.id,
                 allow_sending_without_reply=True,
-            )
+            ),
         )
 
 
-async def think_create(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def think_create(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str
+) -> None:
     logger.info("TELEGRAM: Processing think request", update=update)
 
     if update.message and update.message.text and update.effective_chat:
-        asyncio.create_task(
-            context.bot.send_message(
+        scheduler.submit(
+            update.effective_chat.id,
+            partial(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 parse_mode=ParseMode.MARKDOWN,
-                text=meow_say(
-                    update.message.text.replace(MeowCommand.THINK.telegram(), "")
-                    .replace(str(MeowCommand.THINK), "")
-                    .strip(),
-                    is_cowthink=True,
-                ),
+                text=meow_say(argument, is_cowthink=True),
                 reply_to_message_id=update.message.id,
                 allow_sending_without_reply=True,
-            )
+            ),
         )
 
 
 async def updates_consume() -> None:
-    while update_dict := await settings.telegram_updates.get():
-        asyncio.create_task(
-            application.update_queue.put(Update.de_json(update_dict, application.bot))
-        )
+    global application
+
+    while update_bodies := await settings.telegram_updates.get_many():
+        for update_body in update_bodies:
+            # the web tier forwards bodies unchecked, a malformed one is dropped
+            # here rather than stopping every update queued after it
+            try:
+                update = Update.de_json(json.loads(update_body), application.bot)
+            except (ValueError, TypeError, AttributeError) as exception:
+                logger.error(
+                    "TELEGRAM: Unable to decode an update",
+                    update_body=update_body[:256],
+                    exc_info=exception,
+                )
+                continue
+
+            await application.update_queue.put(update)
+
+
+async def updates_poll() -> None:
+    global application
+
+    logger.info(
+        "TELEGRAM: Polling for updates",
+        limit=settings.TELEGRAM_POLL_LIMIT,
+        timeout=settings.TELEGRAM_POLL_TIMEOUT,
+    )
+
+    offset, is_webhook_deleted = None, False
+    while True:
+        try:
+            # getUpdates is refused while a webhook is set, removing it is
+            # retried like a poll, so a hiccup at startup does not end polling
+            if not is_webhook_deleted:
+                await application.bot.delete_webhook()
+                is_webhook_deleted = True
+
+            # a long poll, it returns as soon as there is anything, with up to
+            # limit updates, or empty once the timeout runs out
+            update_tuple = await application.bot.get_updates(
+                offset=offset,
+                limit=settings.TELEGRAM_POLL_LIMIT,
+                timeout=settings.TELEGRAM_POLL_TIMEOUT,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        except TimedOut:
+            continue
+        except TelegramError as exception:
+            logger.error("TELEGRAM: Unable to poll for updates", exc_info=exception)
+            await asyncio.sleep(
+                retry_after(exception) or settings.TELEGRAM_POLL_BACKOFF
+            )
+            continue
+
+        for update in update_tuple:
+            await application.update_queue.put(update)
+
+        if update_tuple:
+            # everything before the offset is acknowledged on the next poll
+            offset = update_tuple[-1].update_id + 1
+
+
+supervisor = Task_Supervisor("telegram")
+scheduler = Send_Scheduler(
+    "telegram",
+    Token_Bucket(settings.TELEGRAM_GLOBAL_RATE, settings.TELEGRAM_GLOBAL_RATE),
+    chat_bucket,
+    retry_after,
+)
+router = Command_Router(
+    {
+        MeowCommand.FACT: fact_fetch,
+        MeowCommand.ISBLOCKED: blockedornot_fetch,
+        MeowCommand.PETROL: petrol_fetch,
+        MeowCommand.PROMPT: prompt_create,
+        MeowCommand.SAY: say_create,
+        MeowCommand.THINK: think_create,
+    },
+    fallback=photo_send,
+    prefixes="!/",
+)
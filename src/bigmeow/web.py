@@ -1,19 +1,22 @@
 import asyncio
+import hmac
 import json
 import os
-from typing import Annotated
+import socket
+from typing import Annotated, Coroutine
 
 import aiohttp
 import structlog
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, Header, Request
-from fastapi.responses import PlainTextResponse
-from telegram.constants import ParseMode
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 import bigmeow.settings as settings
-from bigmeow.common import check_is_debug
+from bigmeow.common import session_close, session_get
 from bigmeow.meow import meow_say
+from bigmeow.metrics import metrics
+from bigmeow.supervisor import Task_Supervisor
 
 load_dotenv()
 
@@ -21,23 +24,21 @@ logger = structlog.get_logger()
 
 
 app = FastAPI()
+supervisor = Task_Supervisor("web")
 
-WEB_SECRET_PING = os.environ["WEB_SECRET_PING"]
-WEB_SECRET_PASSWORD = os.environ["WEB_SECRET_PASSWORD"]
 WEB_SECRET_PING_USER = "BigMeow"
 
 
 async def check_is_reachable() -> bool:
-    global WEB_SECRET_PING_USER, WEB_SECRET_PASSWORD
+    global WEB_SECRET_PING_USER
 
     result = False
 
-    ping_url = f'{os.environ["WEBHOOK_URL"]}/{WEB_SECRET_PING}'
+    ping_url = f'{os.environ["WEBHOOK_URL"]}/{os.environ["WEB_SECRET_PING"]}'
 
-    async with aiohttp.request(
-        "GET",
+    async with session_get().get(
         ping_url,
-        auth=aiohttp.BasicAuth(WEB_SECRET_PING_USER, WEB_SECRET_PASSWORD),
+        auth=aiohttp.BasicAuth(WEB_SECRET_PING_USER, os.environ["WEB_SECRET_PASSWORD"]),
     ) as response:
         if response.status == 200 and (await response.text()).strip() == "pong":
             result = True
@@ -46,45 +47,111 @@ async def check_is_reachable() -> bool:
 
 
 def check_login_is_valid(authorization: str | None) -> bool:
-    global WEB_SECRET_PING_USER, WEB_SECRET_PASSWORD
+    global WEB_SECRET_PING_USER
 
     result = False
 
     if authorization:
         auth = aiohttp.BasicAuth.decode(authorization)
         result = auth.login == WEB_SECRET_PING_USER and (
-            auth.password == WEB_SECRET_PASSWORD
+            auth.password == os.environ["WEB_SECRET_PASSWORD"]
         )
 
     return result
 
 
-async def run(exit_event: settings.PEvent) -> None:
-    is_debug = check_is_debug()
+def http_protocol() -> str:
+    try:
+        import httptools  # noqa: F401
+    except ImportError:
+        return "h11"
+
+    return "httptools"
+
+
+async def run(exit_event: settings.PEvent, worker: int = 0) -> None:
+    port = int(os.environ.get("WEBHOOK_PORT", "8080"))
+
+    # the secret is part of the path, so the route waits until it is read
+    app.add_api_route(
+        f'/{os.environ["WEB_SECRET_PING"]}',
+        pong_get,
+        methods=["GET"],
+        response_class=PlainTextResponse,
+        include_in_schema=False,
+    )
 
     server = uvicorn.Server(
         uvicorn.Config(
             "bigmeow.web:app",
             host="0.0.0.0",
-            port=int(os.environ.get("WEBHOOK_PORT", "8080")),
+            port=port,
             log_level="info",
-            workers=None if is_debug else 4,
-            reload=is_debug,
+            # serve() runs on the loop process_run started, EVENT_LOOP picks
+            # that one, the parser is httptools whenever it is installed
+            loop="none",
+            http=http_protocol(),
         )
     )
 
-    logger.info("WEB: Web server is starting")
-    asyncio.create_task(server.serve())
+    logger.info("WEB: Web server is starting", worker=worker, port=port)
+    serve_task = asyncio.create_task(
+        server.serve(sockets=[socket_bind("0.0.0.0", port)])
+    )
 
-    if await check_is_reachable():
-        logger.info("WEB: Web application is up and reachable")
-    else:
-        raise Exception("Website is unreachable")
+    supervisor.spawn("metrics", metrics.monitor(f"web.{worker}", exit_event))
+
+    # every worker shares the port, checking from one of them is enough, and
+    # it runs aside so a slow round trip never holds up the rest of startup
+    if worker == 0:
+        supervisor.spawn("reachable", reachable_check(server, serve_task))
 
     await exit_event.wait()
 
-    logger.info("WEB: Webserver is stopping")
+    logger.info("WEB: Webserver is stopping", worker=worker)
     await server.shutdown()
+    await supervisor.close()
+    await session_close()
+
+
+async def reachable_check(server: uvicorn.Server, serve_task: asyncio.Task) -> None:
+    while not (server.started or serve_task.done()):
+        await asyncio.sleep(0.1)
+
+    try:
+        is_reachable = await check_is_reachable()
+    except aiohttp.ClientError as exception:
+        logger.error("WEB: Unable to reach web application", exc_info=exception)
+        is_reachable = False
+
+    if is_reachable:
+        logger.info("WEB: Web application is up and reachable")
+    else:
+        logger.error("WEB: Web application is unreachable")
+
+    settings.readiness.mark("web", is_reachable)
+
+
+def socket_bind(host: str, port: int) -> socket.socket:
+    # asyncio only turns on TCP_NODELAY for sockets that name IPPROTO_TCP,
+    # without it every keep-alive response waits out a delayed ACK
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    # each worker binds its own socket, and the kernel spreads incoming
+    # connections across all of them
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+
+    return sock
+
+
+async def supervised(command: str, coro: Coroutine) -> None:
+    # a saturated worker turns requests away, Telegram retries the webhook later
+    if (future := supervisor.spawn(command, coro)) is None:
+        raise HTTPException(status_code=503, detail="Too many requests in flight")
+
+    await future
 
 
 #
@@ -98,24 +165,50 @@ async def index_get() -> str:
     return "Hello world"
 
 
-@app.get(
-    f"/{WEB_SECRET_PING}", response_class=PlainTextResponse, include_in_schema=False
-)
+@app.get("/healthz", response_class=PlainTextResponse, include_in_schema=False)
+async def healthz_get() -> str:
+    # liveness, answering at all is the whole check
+    return "ok"
+
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz_get() -> JSONResponse:
+    # readiness, whether the caches a reply depends on are filled yet
+    return JSONResponse(
+        settings.readiness.stats(),
+        status_code=200 if settings.readiness.is_ready() else 503,
+    )
+
+
 async def pong_get(authorization: Annotated[str, Header()]) -> str:
     assert check_login_is_valid(authorization)  # auth check
 
     return "pong"
 
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics_get(authorization: Annotated[str, Header()]) -> PlainTextResponse:
+    assert check_login_is_valid(authorization)  # auth check
+
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.post("/telegram", include_in_schema=False)
 async def telegram_post(
     request: Request, x_telegram_bot_api_secret_token: Annotated[str, Header()]
 ) -> None:
-    if not settings.WEB_TELEGRAM_TOKEN == x_telegram_bot_api_secret_token:
+    if not hmac.compare_digest(
+        os.environ["WEB_TELEGRAM_TOKEN"].encode(),
+        x_telegram_bot_api_secret_token.encode(),
+    ):
         return
 
     logger.info("WEBHOOK: Webhook receives a telegram request")
-    asyncio.create_task(settings.telegram_updates.put(await request.json()))
+
+    # forwarded as raw bytes, the bot process decodes it once
+    await supervised("telegram", settings.telegram_updates.feed(await request.body()))
 
 
 @app.post("/chat", include_in_schema=False)
@@ -136,28 +229,31 @@ async def chat_post(
         case "telegram":
             chat_id, message_id = json.loads(x_destination)
 
-            asyncio.create_task(
+            await supervised(
+                "chat",
                 settings.telegram_messages.put(
                     {
                         "text": meow_say(text),
                         "chat_id": chat_id,
-                        "parse_mode": ParseMode.MARKDOWN,
+                        # ParseMode.MARKDOWN, without importing telegram
+                        "parse_mode": "Markdown",
                         "reply_to_message_id": message_id,
                         "allow_sending_without_reply": True,
                     }
-                )
+                ),
             )
 
         case "discord":
             channel_id, message_id = json.loads(x_destination)
-            asyncio.create_task(
+            await supervised(
+                "chat",
                 settings.discord_messages.put(
                     {
                         "content": meow_say(text),
                         "channel_id": channel_id,
                         "message_id": message_id,
                     }
-                )
+                ),
             )
 
         case _:
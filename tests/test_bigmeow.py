@@ -1,5 +1,933 @@
-from bigmeow import __version__
+import asyncio
+import datetime
+import io
+import json
+import threading
+
+import aiohttp
+import pytest
+
+from bigmeow import __version__, settings
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_event_wakes_waiter_from_another_thread():
+    async def waiter(event: settings.Event) -> bool:
+        threading.Timer(0.05, event.set).start()
+
+        return await event.wait(timeout=5)
+
+    assert asyncio.run(waiter(settings.Event()))
+
+
+def test_pevent_wait_times_out_until_set():
+    event = settings.PEvent()
+
+    assert not asyncio.run(event.wait(timeout=0.05))
+
+    event.set()
+
+    assert event.is_set()
+    assert asyncio.run(event.wait(timeout=0.05))
+
+
+def test_pqueue_applies_backpressure_across_processes():
+    import multiprocessing
+
+    queue = settings.PQueue(maxsize=2)
+
+    def produce() -> None:
+        asyncio.run(queue.put_many(list(range(10))))
+
+    async def consume() -> list[int]:
+        result = []
+
+        while len(result) < 10:
+            assert queue.qsize() <= 2
+            result.extend(await queue.get_many())
+
+        return result
+
+    producer = multiprocessing.get_context("fork").Process(target=produce)
+    producer.start()
+
+    assert asyncio.run(consume()) == list(range(10))
+
+    producer.join()
+    assert queue.qsize() == 0
+
+
+def test_pqueue_put_many_leaves_the_loop_free_while_the_pipe_is_full():
+    queue = settings.PQueue(maxsize=4)
+
+    async def roundtrip() -> list[bytes]:
+        # a single batch larger than the pipe, drained by the same loop
+        producer = asyncio.create_task(queue.put_many([b"x" * 256 * 1024] * 4))
+        result = await asyncio.wait_for(queue.get_many(), timeout=5)
+
+        await producer
+
+        return result
+
+    assert [len(item) for item in asyncio.run(roundtrip())] == [256 * 1024] * 4
+
+
+def test_pqueue_get_many_leaves_the_loop_free_while_another_consumer_reads():
+    queue = settings.PQueue(maxsize=4)
+
+    async def consume() -> list[int]:
+        await queue.put(1)
+
+        # as if another process held the read lock
+        queue._rlock.acquire()
+        consumer = asyncio.create_task(queue.get_many())
+
+        await asyncio.sleep(0.05)
+        assert not consumer.done()
+        queue._rlock.release()
+
+        return await asyncio.wait_for(consumer, timeout=5)
+
+    assert asyncio.run(consume()) == [1]
+
+
+def test_cat_pool_counts_hits_and_misses():
+    from io import BytesIO
+
+    pool = settings.Cat_Pool(size=2, ttl=60)
+    pool.put(BytesIO(b"meow"))
+
+    assert pool.deficit() == 1
+    assert pool.get() is not None
+    assert pool.get() is None
+    assert pool.stats()["hits"] == 1 and pool.stats()["misses"] == 1
+
+
+def test_readiness_waits_for_required_steps_and_empty_caches_return_none():
+    readiness = settings.Readiness(("cat", "fact"), 4096)
+
+    readiness.mark("fact")
+    readiness.mark("petrol", False)
+
+    assert not readiness.is_ready()
+    assert readiness.stats() == {"cat": False, "fact": True, "petrol": False}
+
+    readiness.mark("cat")
+
+    assert readiness.is_ready()
+    assert settings.Cat_Cache(4096).get() is None
+    assert settings.Fact_Cache(4096).get() is None
+
+
+def test_say_cache_evicts_least_recently_used_within_budget():
+    cache = settings.Say_Cache(size=10, entry_limit=8)
+
+    cache.cache(("a", False, "meow", True), "aaaa")
+    cache.cache(("b", False, "meow", True), "bbbb")
+    cache.get(("a", False, "meow", True))
+    cache.cache(("c", False, "meow", True), "cccc")
+    cache.cache(("d", False, "meow", True), "d" * 9)
+
+    assert cache.get(("a", False, "meow", True)) == "aaaa"
+    assert cache.get(("b", False, "meow", True)) is None
+    assert cache.get(("d", False, "meow", True)) is None
+    assert cache.used <= 10
+
+
+def test_command_router_slices_argument_and_falls_back_to_meow():
+    from bigmeow.common import Command_Router
+    from bigmeow.settings import MeowCommand
+
+    router = Command_Router(
+        {command: command.value for command in MeowCommand},
+        fallback="photo",
+        prefixes="!/",
+    )
+
+    assert router.match("!meowsay  hello world ") == ("meowsay", "hello world")
+    assert router.match("/meowisblocked@bigmeow_bot example.com") == (
+        "meowisblocked",
+        "example.com",
+    )
+    assert router.match("!meowfact") == ("meowfact", "")
+    assert router.match("I say Meow") == ("photo", "I say Meow")
+    assert router.match("!meowsa") == ("photo", "!meowsa")
+    assert router.match("hello") is None
+    assert router.match(None) is None
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight, calls = settings.Single_Flight(), []
+
+    async def fetch() -> str:
+        calls.append(1)
+        await asyncio.sleep(0.05)
+
+        return "safe"
+
+    async def lookup() -> list[str]:
+        return await asyncio.gather(
+            *(flight.run("example.com", fetch) for _ in range(5))
+        )
+
+    assert asyncio.run(lookup()) == ["safe"] * 5
+    assert len(calls) == 1
+    assert not flight.flight_dict
+
+
+def test_meowblocked_normalize():
+    from bigmeow.meow import meowblocked_normalize
+
+    assert meowblocked_normalize(" HTTPS://Example.com/path?q=1 ") == "example.com"
+    assert meowblocked_normalize("example.com.") == "example.com"
+    assert meowblocked_normalize("example.com:8080/") == "example.com"
+
+
+def test_shared_value_is_visible_across_processes():
+    import multiprocessing
+
+    shared = settings.Shared_Value(["meow"], 1024)
+
+    child = multiprocessing.get_context("fork").Process(
+        target=shared.update, args=(lambda value: value + ["purr"],)
+    )
+    child.start()
+    child.join()
+
+    assert shared.load() == ["meow", "purr"]
+    assert not shared.store(["x" * 2048])
+    assert shared.load() == ["meow", "purr"]
+
+
+def test_pqueue_feed_sends_one_batch_per_loop_iteration():
+    import pickle
+
+    queue = settings.PQueue(maxsize=8)
+
+    async def burst() -> None:
+        await asyncio.gather(*(queue.feed(b"%d" % idx) for idx in range(5)))
+
+    asyncio.run(burst())
+
+    # the whole burst crossed the pipe as a single frame
+    assert pickle.loads(queue._reader.recv_bytes()) == [b"0", b"1", b"2", b"3", b"4"]
+    assert not queue._reader.poll()
+
+
+def test_send_scheduler_puts_interactive_ahead_and_coalesces_pushes():
+    from bigmeow.outbound import Lane, Send_Scheduler, Token_Bucket
+
+    sent = []
+
+    async def send(text: str) -> str:
+        sent.append(text)
+
+        return text
+
+    async def schedule() -> list[str]:
+        scheduler = Send_Scheduler(
+            "test",
+            Token_Bucket(100, 1),
+            lambda _: Token_Bucket(100, 100),
+            lambda _: None,
+        )
+        exit_event = asyncio.Event()
+
+        futures = [
+            scheduler.submit(1, lambda: send("push"), lane=Lane.PUSH, key="push"),
+            scheduler.submit(2, lambda: send("push"), lane=Lane.PUSH, key="push"),
+            scheduler.submit(3, lambda: send("reply")),
+        ]
+        task = asyncio.create_task(scheduler.run(exit_event))
+        result = await asyncio.gather(*futures)
+
+        exit_event.set()
+        scheduler.wakeup.set()
+        await task
+
+        assert scheduler.stats()["coalesced"] == 1
+
+        return result
+
+    assert asyncio.run(schedule()) == ["push", "push", "reply"]
+    assert sent == ["reply", "push"]
+
+
+def test_task_supervisor_caps_queues_and_sheds():
+    from bigmeow.supervisor import Task_Supervisor
+
+    running, peak = [], []
+
+    async def work() -> None:
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    async def supervise() -> dict:
+        supervisor = Task_Supervisor("test", {"work": 2}, queue_limit=2)
+        futures = [supervisor.spawn("work", work()) for _ in range(5)]
+
+        assert futures[-1] is None
+        await asyncio.gather(*futures[:-1])
+
+        return supervisor.stats()["work"]
+
+    stats = asyncio.run(supervise())
+
+    assert max(peak) == 2
+    assert (stats["done"], stats["shed"], stats["in_flight"]) == (4, 1, 0)
+
+
+def test_metrics_render_adds_up_histograms_in_prometheus_format():
+    from bigmeow.metrics import Metrics
+
+    metrics = Metrics(2, 64 * 1024)
+    metrics.observe("bigmeow_command_duration_seconds", 0.02, command="meowfact")
+    metrics.observe("bigmeow_command_duration_seconds", 20, command="meowfact")
+    metrics.count("bigmeow_cache_requests_total", cache="petrol", result="hit")
+
+    rendered = metrics.render()
+
+    assert (
+        'bigmeow_command_duration_seconds_bucket{command="meowfact",le="0.025"} 1'
+        in rendered
+    )
+    assert (
+        'bigmeow_command_duration_seconds_bucket{command="meowfact",le="+Inf"} 2'
+        in rendered
+    )
+    assert 'bigmeow_command_duration_seconds_count{command="meowfact"} 2' in rendered
+    assert 'bigmeow_cache_requests_total{cache="petrol",result="hit"} 1' in rendered
+    assert 'bigmeow_queue_depth{queue="telegram_updates"} 0' in rendered
+
+
+def test_photo_handle_cache_keeps_newest_handles_until_they_expire():
+    cache = settings.Photo_Handle_Cache(64 * 1024, 2, 60)
+
+    for digest in ("a", "b", "c"):
+        cache.cache(digest, "telegram", f"file-{digest}")
+
+    assert cache.get("a", "telegram") is None
+    assert cache.get("c", "telegram") == "file-c"
+    assert cache.get("c", "discord") is None
+
+    cache.forget("c", "telegram")
+    assert cache.get("c", "telegram") is None
+
+    expired = settings.Photo_Handle_Cache(64 * 1024, 2, -1)
+    expired.cache("a", "discord", "https://cdn.example.com/a.png")
+    assert expired.get("a", "discord") is None
+
+
+def test_photo_normalize_fits_budget_and_leaves_the_rest_alone():
+    from bigmeow.photo import photo_normalize
+
+    Image = pytest.importorskip("PIL.Image")
+
+    output = io.BytesIO()
+    Image.effect_noise((1024, 1024), 48).convert("RGB").save(output, "PNG")
+    payload = output.getvalue()
+
+    normalized = photo_normalize(payload, 64 * 1024, 1280)
+    assert len(normalized) <= 64 * 1024
+    assert Image.open(io.BytesIO(normalized)).format == "JPEG"
+
+    assert photo_normalize(b"not a photo", 64 * 1024, 1280) == b"not a photo"
+
+
+def test_meow_photo_normalize_warns_once_without_pillow(monkeypatch):
+    import sys
+
+    from structlog.testing import capture_logs
+
+    from bigmeow import meow
+
+    monkeypatch.setitem(sys.modules, "PIL", None)
+    monkeypatch.setattr(settings, "PHOTO_BUDGET", 16)
+    meow.meow_photo_is_pillow.cache_clear()
+
+    async def normalize() -> list[bytes]:
+        return [
+            (await meow.meow_photo_normalize(io.BytesIO(b"x" * 64))).getvalue()
+            for _ in range(3)
+        ]
+
+    try:
+        with capture_logs() as log_list:
+            assert asyncio.run(normalize()) == [b"x" * 64] * 3
+    finally:
+        meow.meow_photo_is_pillow.cache_clear()
+
+    assert [log["log_level"] for log in log_list] == ["warning"]
+
+
+class Petrol_Response:
+    def __init__(self, status: int, lines: list[bytes], headers: dict) -> None:
+        self.status, self.lines, self.headers = status, lines, headers
+
+    async def __aenter__(self) -> "Petrol_Response":
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        pass
+
+    @property
+    async def content(self):
+        for line in self.lines:
+            yield line
+
+
+class Petrol_Session:
+    def __init__(self, response: Petrol_Response) -> None:
+        self.response, self.headers = response, None
+
+    def get(self, _url: str, headers: dict) -> Petrol_Response:
+        self.headers = headers
+
+        return self.response
+
+
+def petrol_fetch(
+    monkeypatch, response: Petrol_Response, source: settings.Latest_Source, current
+) -> tuple[settings.Latest, dict]:
+    from bigmeow import meow
+
+    session = Petrol_Session(response)
+    latest_source = settings.Shared_Value(source, 4096)
+
+    monkeypatch.setattr(meow, "session_get", lambda: session)
+    monkeypatch.setattr(settings, "latest_source", latest_source)
+
+    result = asyncio.run(meow.meowpetrol_fetch("https://example.com/fuel.csv", current))
+
+    return result, {"headers": session.headers, "source": latest_source.load()}
+
+
+PETROL_FIELDNAMES = ("series_type", "date", "ron95", "ron97", "diesel")
+PETROL_EMPTY = settings.Latest(
+    settings.Level(datetime.date.min, 0, 0, 0),
+    settings.Change(datetime.date.min, 0, 0, 0),
+)
+
+
+def test_meowpetrol_fetch_keeps_current_when_not_modified(monkeypatch):
+    current = settings.Latest(
+        settings.Level(datetime.date(2024, 6, 27), 2.05, 3.47, 3.35),
+        settings.Change(datetime.date(2024, 6, 27), 0, 0, 0),
+    )
+    source = settings.Latest_Source('"v1"', "Thu, 27 Jun 2024", PETROL_FIELDNAMES)
+
+    result, seen = petrol_fetch(
+        monkeypatch, Petrol_Response(304, [], {}), source, current
+    )
+
+    assert result is current
+    assert seen["headers"] == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Thu, 27 Jun 2024",
+        "Range": "bytes=-4096",
+    }
+    assert seen["source"] == source
+
+
+def test_meowpetrol_fetch_drops_the_partial_first_line_of_a_range(monkeypatch):
+    response = Petrol_Response(
+        206,
+        [
+            # the range starts inside a row, parsed it would be a wrong price
+            b"level,2024-07-04,9.99,9.99,9.99\n",
+            b"level,2024-06-27,2.05,3.47,3.35\n",
+            b"change,2024-06-27,0.00,-0.05,0.00\n",
+            b"\n",
+        ],
+        {"ETag": '"v2"'},
+    )
+    source = settings.Latest_Source(None, None, PETROL_FIELDNAMES)
+
+    result, seen = petrol_fetch(monkeypatch, response, source, PETROL_EMPTY)
+
+    assert result.level == settings.Level(datetime.date(2024, 6, 27), 2.05, 3.47, 3.35)
+    assert result.change == settings.Change(datetime.date(2024, 6, 27), 0, -0.05, 0)
+    assert seen["headers"] == {"Range": "bytes=-4096"}
+    assert seen["source"] == settings.Latest_Source('"v2"', None, PETROL_FIELDNAMES)
+
+
+def test_meowpetrol_fetch_reads_the_whole_list_the_first_time(monkeypatch):
+    response = Petrol_Response(
+        200,
+        [
+            b"series_type,date,ron95,ron97,diesel\n",
+            b"level,2024-06-20,2.05,3.47,3.35\n",
+            b"level,2024-06-27,2.05,3.42,3.35\n",
+            b"change,2024-06-27,0.00,-0.05,0.00\n",
+        ],
+        {"ETag": '"v1"', "Last-Modified": "Thu, 27 Jun 2024"},
+    )
+    source = settings.Latest_Source(None, None, ())
+
+    result, seen = petrol_fetch(monkeypatch, response, source, PETROL_EMPTY)
+
+    assert result.level == settings.Level(datetime.date(2024, 6, 27), 2.05, 3.42, 3.35)
+    assert seen["headers"] == {}
+    assert seen["source"] == settings.Latest_Source(
+        '"v1"', "Thu, 27 Jun 2024", PETROL_FIELDNAMES
+    )
+
+
+def test_readyz_answers_503_until_the_required_caches_are_warm(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from bigmeow import web
+
+    readiness = settings.Readiness(("cat", "fact"), 4096)
+    monkeypatch.setattr(settings, "readiness", readiness)
+
+    client = TestClient(web.app)
+    readiness.mark("cat")
+
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json() == {"cat": True, "fact": False}
+
+    readiness.mark("fact")
+
+    assert client.get("/readyz").status_code == 200
+    assert client.get("/healthz").text == "ok"
+
+
+def test_replies_fall_back_when_upstreams_fail_and_caches_are_empty(monkeypatch):
+    from bigmeow import discord, meow
+
+    async def fetch_fact() -> None:
+        return None
+
+    async def download_photo() -> None:
+        raise aiohttp.ClientError("unreachable")
+
+    async def say_create(_message, argument: str) -> None:
+        said.append(argument)
+
+    said: list[str] = []
+    monkeypatch.setattr(meow, "meowfact_fetch", fetch_fact)
+    monkeypatch.setattr(meow, "meow_download_photo", download_photo)
+    monkeypatch.setattr(discord, "say_create", say_create)
+    monkeypatch.setattr(settings, "cat_cache", settings.Cat_Cache(4096))
+    monkeypatch.setattr(settings, "cat_pool", settings.Cat_Pool(size=1, ttl=60))
+    monkeypatch.setattr(settings, "fact_cache", settings.Fact_Cache(4096))
+
+    assert meow.FACT_MISSING in asyncio.run(meow.meow_fact())
+
+    asyncio.run(discord.photo_send(None, "meow"))  # type: ignore
+    assert said == [meow.PHOTO_MISSING]
+
+
+def test_shard_process_serves_photos_from_its_own_prefetched_pool(monkeypatch):
+    from bigmeow import discord, main, meow
+
+    downloaded, served = [], []
+
+    async def download_photo() -> io.BytesIO:
+        downloaded.append(1)
+
+        return io.BytesIO(b"meow")
+
+    async def run(exit_event: settings.PEvent, shard_ids: list[int]) -> None:
+        while not settings.cat_pool.photo_list:
+            await asyncio.sleep(0.01)
+
+        served.append((shard_ids, (await meow.meow_fetch_photo()).getvalue()))
+        exit_event.set()
+
+    monkeypatch.setattr(meow, "meow_download_photo", download_photo)
+    monkeypatch.setattr(discord, "run", run)
+    monkeypatch.setattr(settings, "cat_cache", settings.Cat_Cache(4096))
+    monkeypatch.setattr(settings, "cat_pool", settings.cat_pool)
+
+    asyncio.run(asyncio.wait_for(main.shard_run(settings.PEvent(), [2, 3]), 5))
+
+    assert served == [([2, 3], b"meow")]
+    assert settings.cat_pool.stats()["hits"] == 1
+    assert len(downloaded) == settings.CAT_POOL_SIZE
+
+
+def test_shards_spread_over_processes_and_split_the_global_rate(monkeypatch):
+    from bigmeow import discord
+    from bigmeow.main import shard_slices
+
+    assert shard_slices(4, 2) == [[0, 1], [2, 3]]
+    assert shard_slices(5, 2) == [[0, 1], [2, 3, 4]]
+    assert shard_slices(1, 2) == [[0]]
+    assert shard_slices(4, 0) == []
+
+    monkeypatch.setattr(settings, "DISCORD_GLOBAL_RATE", 50.0)
+    monkeypatch.setattr(settings, "DISCORD_SHARD_COUNT", 1)
+    monkeypatch.setattr(settings, "DISCORD_PROCESSES", 2)
+    assert discord.global_bucket().rate == 50
+
+    monkeypatch.setattr(settings, "DISCORD_SHARD_COUNT", 4)
+    assert discord.global_bucket().rate == 25
+
+    monkeypatch.setattr(settings, "DISCORD_PROCESSES", 0)
+    assert discord.global_bucket().rate == 50
+
+
+def test_loop_run_picks_the_event_loop_without_asyncio_runner(monkeypatch):
+    from bigmeow.common import loop_run
+
+    uvloop = pytest.importorskip("uvloop")
+
+    async def loop_type() -> type:
+        return type(asyncio.get_running_loop())
+
+    monkeypatch.setattr(settings, "EVENT_LOOP", "uvloop")
+    assert loop_run(loop_type()) is uvloop.Loop
+
+    monkeypatch.delattr(asyncio, "Runner")
+    try:
+        assert loop_run(loop_type()) is uvloop.Loop
+    finally:
+        asyncio.set_event_loop_policy(None)
+
+    monkeypatch.setattr(settings, "EVENT_LOOP", "asyncio")
+    assert loop_run(loop_type()) is not uvloop.Loop
+
+
+def test_telegram_updates_consume_skips_bodies_that_do_not_decode(monkeypatch):
+    from types import SimpleNamespace
+
+    from telegram import Bot
+
+    from bigmeow import telegram
+    from bigmeow.loadgen import update_create
+
+    application = SimpleNamespace(bot=Bot("1:test"), update_queue=asyncio.Queue())
+    monkeypatch.setattr(telegram, "application", application, raising=False)
+    monkeypatch.setattr(settings, "telegram_updates", settings.PQueue(maxsize=8))
+
+    async def consume() -> int:
+        await settings.telegram_updates.put_many(
+            [b"not json", b"[]", json.dumps(update_create(7, 10, 1, "meow")).encode()]
+        )
+        task = asyncio.create_task(telegram.updates_consume())
+        update = await asyncio.wait_for(application.update_queue.get(), timeout=5)
+        task.cancel()
+
+        assert settings.telegram_updates.qsize() == 0
+
+        return update.update_id
+
+    assert asyncio.run(consume()) == 7
+
+
+def test_discord_messages_consume_resolves_each_channel_once(monkeypatch):
+    from types import SimpleNamespace
+
+    import discord as discord_py
+
+    from bigmeow import discord
+
+    sent, fetched = [], []
+
+    class Channel:
+        def __init__(self, channel_id: int) -> None:
+            self.id = channel_id
+
+        def get_partial_message(self, message_id: int) -> SimpleNamespace:
+            return SimpleNamespace(
+                id=message_id,
+                channel=self,
+                to_reference=lambda fail_if_not_exists: (
+                    message_id,
+                    fail_if_not_exists,
+                ),
+            )
+
+        async def send(self, reference: tuple, content: str) -> None:
+            sent.append((self.id, reference, content))
+
+    async def fetch_channel(channel_id: int) -> Channel:
+        fetched.append(channel_id)
+
+        if channel_id == 3:
+            raise discord_py.InvalidData("gone")
+
+        return Channel(channel_id)
+
+    def submit(_key, func, **_kwargs) -> None:
+        # sent straight away, in the order they were submitted
+        pending.append(asyncio.ensure_future(func()))
+
+    pending: list[asyncio.Future] = []
+    client = SimpleNamespace(
+        # channel 1 is in the gateway cache, the others are not
+        get_channel=lambda channel_id: Channel(1) if channel_id == 1 else None,
+        fetch_channel=fetch_channel,
+    )
+    monkeypatch.setattr(discord, "client", client, raising=False)
+    monkeypatch.setattr(discord, "channel_cache", settings.TTL_Cache(8, 60))
+    monkeypatch.setattr(discord.scheduler, "submit", submit)
+    monkeypatch.setattr(settings, "discord_messages", settings.PQueue(maxsize=8))
+
+    async def consume() -> None:
+        task = asyncio.create_task(discord.messages_consume())
+
+        # how many replies have gone out once each batch is handled
+        for batch, replies in (
+            ([(2, 10), (2, 11), (1, 12), (3, 13)], 3),
+            ([(2, 14)], 4),
+        ):
+            await settings.discord_messages.put_many(
+                [
+                    {
+                        "channel_id": channel_id,
+                        "message_id": message_id,
+                        "content": "hi",
+                    }
+                    for channel_id, message_id in batch
+                ]
+            )
+            while len(sent) < replies:
+                await asyncio.sleep(0.01)
+
+        task.cancel()
+
+    asyncio.run(consume())
+
+    # the REST fetch happens once per channel, then the LRU answers
+    assert fetched == [2, 3]
+    assert sent == [
+        (2, (10, False), "hi"),
+        (2, (11, False), "hi"),
+        (1, (12, False), "hi"),
+        (2, (14, False), "hi"),
+    ]
+
+
+def test_metrics_render_keeps_large_values_exact():
+    from bigmeow.metrics import Metrics
+
+    metrics = Metrics(2, 64 * 1024)
+    metrics.count("bigmeow_photo_bytes_total", 12345678, stage="downloaded")
+
+    for _ in range(3):
+        metrics.observe("bigmeow_upstream_duration_seconds", 0.1, host="a")
+
+    metrics.observe("bigmeow_upstream_duration_seconds", 1234567.25, host="a")
+
+    rendered = metrics.render()
+
+    assert 'bigmeow_photo_bytes_total{stage="downloaded"} 12345678\n' in rendered
+    assert 'bigmeow_upstream_duration_seconds_count{host="a"} 4\n' in rendered
+    assert (
+        f'bigmeow_upstream_duration_seconds_sum{{host="a"}} {0.1 * 3 + 1234567.25!r}'
+        in rendered
+    )
+
+
+def test_metrics_slots_cover_every_process_and_warn_when_they_run_out(monkeypatch):
+    from bigmeow import metrics as metrics_module
+    from bigmeow.metrics import Metrics, slots_count
+
+    monkeypatch.setenv("WEB_WORKERS", "24")
+    monkeypatch.setattr(settings, "DISCORD_PROCESSES", 8)
+    assert slots_count() == 33
+
+    warnings = []
+    monkeypatch.setattr(
+        metrics_module.logger, "warning", lambda event, **_: warnings.append(event)
+    )
+
+    metrics = Metrics(1, 64 * 1024)
+    metrics.slot_next.value = 1
+    metrics.publish()
+    metrics.publish()
+
+    assert len(warnings) == 1
+
+
+def test_startup_imports_keeps_each_module_with_its_direct_imports():
+    from bigmeow.main import startup_imports
+
+    importtime = "\n".join(
+        (
+            "import time: self [us] | cumulative | imported package",
+            "import time:        40 |         40 |     yarl._quoting",
+            "import time:       300 |        340 |   yarl",
+            "import time:        60 |         60 |   structlog",
+            "import time:       100 |        500 | bigmeow.main",
+            "import time:        20 |         20 |   bigmeow.web_only",
+            "import time:        80 |        100 | bigmeow.web",
+            "unrelated output on stderr",
+        )
+    )
+
+    assert startup_imports(importtime) == {
+        "bigmeow.main": (500, [("yarl", 340), ("structlog", 60)]),
+        "bigmeow.web": (100, [("bigmeow.web_only", 20)]),
+    }
+
+
+def test_telegram_updates_poll_retries_and_moves_the_offset(monkeypatch):
+    import socket
+
+    from aiohttp import web
+    from telegram.ext import ApplicationBuilder
+
+    from bigmeow import telegram
+    from bigmeow.loadgen import Telegram_API, sink_serve, update_create
+
+    class Flaky_API(Telegram_API):
+        # the first deleteWebhook fails, every call is recorded
+        def __init__(self) -> None:
+            super().__init__()
+            self.call_list: list[tuple[str, dict]] = []
+
+        async def method_post(self, request: web.Request) -> web.Response:
+            method = request.match_info["method"]
+            self.call_list.append((method, dict(await request.post())))
+
+            if method == "deleteWebhook" and len(self.call_list) < 3:
+                return web.json_response(
+                    {"ok": False, "error_code": 502, "description": "Bad Gateway"},
+                    status=502,
+                )
+
+            return await super().method_post(request)
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    monkeypatch.setattr(settings, "TELEGRAM_POLL_BACKOFF", 0.01)
+    monkeypatch.setattr(settings, "TELEGRAM_POLL_TIMEOUT", 1)
+
+    async def poll() -> tuple[list[int], list[tuple[str, dict]]]:
+        sink = Flaky_API()
+        runner = await sink_serve(sink, port)
+        application = (
+            ApplicationBuilder()
+            .token("test")
+            .base_url(f"http://127.0.0.1:{port}/bot")
+            .build()
+        )
+        monkeypatch.setattr(telegram, "application", application, raising=False)
+
+        for update_id in (5, 6):
+            sink.update_queue.put_nowait(
+                update_create(update_id, 10, update_id, "meow")
+            )
+
+        async with application:
+            task = asyncio.create_task(telegram.updates_poll())
+
+            while not any(
+                method == "getUpdates" and data.get("offset") == "7"
+                for method, data in sink.call_list
+            ):
+                await asyncio.sleep(0.01)
+
+            task.cancel()
+
+        await runner.cleanup()
+
+        update_list = []
+        while not application.update_queue.empty():
+            update_list.append(application.update_queue.get_nowait().update_id)
+
+        return update_list, sink.call_list
+
+    update_list, call_list = asyncio.run(asyncio.wait_for(poll(), 10))
+
+    assert update_list == [5, 6]
+    assert [method for method, _ in call_list[:4]] == [
+        "getMe",
+        "deleteWebhook",
+        "deleteWebhook",
+        "getUpdates",
+    ]
+    assert "offset" not in call_list[3][1]
+
+
+def test_telegram_photo_upload_sends_file_ids_and_uploads_when_refused(monkeypatch):
+    from types import SimpleNamespace
+
+    from telegram.error import BadRequest
+
+    from bigmeow import telegram
+
+    sent = []
+
+    class Bot:
+        async def send_photo(self, photo, **kwargs) -> SimpleNamespace:
+            sent.append(photo)
+
+            if photo == "file-stale":
+                raise BadRequest("Wrong file identifier")
+
+            return SimpleNamespace(
+                photo=[SimpleNamespace(file_id="small"), SimpleNamespace(file_id="big")]
+            )
+
+    cache = settings.Photo_Handle_Cache(64 * 1024, 8, 60)
+    monkeypatch.setattr(settings, "photo_handle_cache", cache)
+
+    async def upload() -> None:
+        photo = io.BytesIO(b"meow")
+
+        cache.cache("a", "telegram", "file-stale")
+        await telegram.photo_upload(Bot(), "a", photo, chat_id=1)
+        await telegram.photo_upload(Bot(), "a", photo, chat_id=1)
+
+    asyncio.run(upload())
+
+    # refused, uploaded again, then sent by the largest size's file_id
+    assert sent == ["file-stale", b"meow", "big"]
+
+
+def test_discord_photo_upload_embeds_until_the_upload_message_is_deleted(monkeypatch):
+    import itertools
+    from types import SimpleNamespace
+
+    from bigmeow import discord
+
+    sent, message_id = [], itertools.count(100)
+
+    class Channel:
+        async def send(self, _content: str, **kwargs) -> SimpleNamespace:
+            sent.append("embed" if "embed" in kwargs else "file")
+
+            return SimpleNamespace(
+                id=(sent_id := next(message_id)),
+                attachments=(
+                    [SimpleNamespace(url=f"https://cdn.example.com/{sent_id}.jpg")]
+                    if "file" in kwargs
+                    else []
+                ),
+            )
+
+    monkeypatch.setattr(
+        settings, "photo_handle_cache", settings.Photo_Handle_Cache(64 * 1024, 8, 60)
+    )
+    reference = SimpleNamespace(channel=Channel())
+
+    async def upload() -> None:
+        await discord.photo_upload(reference, "a", b"meow")  # type: ignore
+        await discord.photo_upload(reference, "a", b"meow")  # type: ignore
+
+        # some other message going away leaves the handle alone
+        await discord.on_raw_message_delete(SimpleNamespace(message_id=999))
+        await discord.photo_upload(reference, "a", b"meow")  # type: ignore
+
+        await discord.on_raw_bulk_message_delete(SimpleNamespace(message_ids={100}))
+        await discord.photo_upload(reference, "a", b"meow")  # type: ignore
+
+    asyncio.run(upload())
+
+    assert sent == ["file", "embed", "embed", "file"]
+    assert settings.photo_handle_cache.get("a", "discord") == (
+        "https://cdn.example.com/103.jpg"
+    )